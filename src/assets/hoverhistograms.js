@@ -0,0 +1,93 @@
+/* Hover histograms, drawn in the browser (see `CLIENTSIDE_HISTOGRAMS` in `pages/alltime.py`) */
+(function () {
+    const DAY_NAMES = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"];
+
+    // placeholder figure, like `PlotHoverHistogram.default` and `PlotHoverHistogram.empty_histogram_figure`
+    function message(text, template) {
+        return {
+            data: [],
+            layout: {
+                xaxis: {visible: false, rangeslider: {visible: false}},
+                yaxis: {visible: false},
+                annotations: [{text: text, xref: "paper", yref: "paper", showarrow: false, font: {size: 10}}],
+                margin: {pad: 3},
+                template: template,
+            },
+        };
+    }
+
+    // precomputed distribution with the hovered value marked, like `PlotHoverHistogram.plot_day_hover_histogram` and `plot_hour_hover_histogram`
+    function histogram(data, distribution, quantity, key, point, curveNumber, title, template) {
+        const bins = ((data.distributions[distribution] || {})[quantity] || {})[key] || {start: [], end: [], percent: []};
+        const traces = [{
+            type: "bar",
+            x: bins.start.map((start, i) => (start + bins.end[i]) / 2),
+            y: bins.percent,
+            width: bins.start.map((start, i) => bins.end[i] - start),
+            customdata: bins.start.map((start, i) => [start, bins.end[i]]),
+            hovertemplate: "<extra></extra>Value: %{customdata[0]:.2f} - %{customdata[1]:.2f}<br>% Share: %{y:.2f}",
+        }];
+        if (point !== null && point !== undefined) {
+            traces.push({
+                type: "scatter",
+                x: [point],
+                mode: "markers",
+                marker: {symbol: "arrow-up"},
+                hovertemplate: (curveNumber === 0 ? "Realized: " : "Predicted: ") + "%{x} <extra></extra>",
+            });
+        }
+        return {
+            data: traces,
+            layout: {
+                title: {text: title},
+                xaxis: {title: {text: data.column_names[quantity], font: {size: 12}}},
+                yaxis: {title: {text: "Percent Share"}},
+                showlegend: false,
+                margin: {pad: 0},
+                template: template,
+            },
+        };
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        hover_histograms: {
+            // `template` is the theme's full template JSON; plotly.js ignores template names
+            render: function (hoverData, template, data, quantity, granularity) {
+                if (!template) {
+                    return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+                }
+                if (!hoverData || !data) {
+                    const placeholder = message("Hover over a point to <br> to display more information!", template);
+                    return [placeholder, placeholder];
+                }
+                const empty = message("No distribution<br>available!", template);
+                if (granularity === "monthlydemand") {
+                    return [empty, empty];
+                }
+
+                // hovered time, as "YYYY-MM-DD" or "YYYY-MM-DD HH:MM"
+                const point = hoverData.points[0];
+                const x = String(point.x);
+                const date = x.slice(0, 10);
+                const hour = x.length > 11 ? parseInt(x.slice(11, 13), 10) : 0;
+
+                // non-prediction curve shows the day's realized demand, the prediction curve its predicted demand (daily only)
+                let dayName, dayPoint = null;
+                if (point.curveNumber === 0) {
+                    dayName = point.customdata[0];
+                    dayPoint = (data.dailydemand[quantity] || {})[date];
+                } else {
+                    dayName = DAY_NAMES[new Date(date + "T00:00:00").getDay()];
+                    dayPoint = granularity === "dailydemand" ? point.y : null;
+                }
+                const dayHistogram = histogram(data, "day", quantity, dayName, dayPoint, point.curveNumber, "Dist. On " + dayName, template);
+
+                if (granularity === "dailydemand") {
+                    return [dayHistogram, empty];
+                }
+                const hourHistogram = histogram(data, "hour", quantity, String(hour), point.y, point.curveNumber, "Dist. On Hour " + hour, template);
+                return [dayHistogram, hourHistogram];
+            },
+        },
+    });
+})();
@@ -6,9 +6,10 @@ from dotenv import load_dotenv
 from dash_bootstrap_templates import ThemeChangerAIO
 from db.utils import db
 
-# connect to Redis
+# connect to Redis, and listen for new snapshots
 load_dotenv()
 r = db.get_redis_connection()
+db.listen_for_snapshots(r)
 
 # app instantiation
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.LUX, dbc.icons.BOOTSTRAP, dbc.icons.FONT_AWESOME, r"assets/dbc.min.css"], suppress_callback_exceptions=True, use_pages=True)
@@ -124,9 +125,10 @@ app.layout = \
             html.Div([
                 dcc.Interval(
                     id="data-refresh-interval-component",
-                    interval=25 * 60 * 1000,  # poll db every 25 minutes
+                    interval=30 * 1000,  # check for a new snapshot every 30 seconds
                     n_intervals=0
                 ),
+                dcc.Store(id="data-version"),
                 dcc.Store(id="data-refresh-signal"),
             ]),
         ]),
@@ -170,14 +172,23 @@ def toggle_navbar_collapse(n, is_open):
 
 @app.callback(
     Output("data-refresh-signal", "data"),
+    Output("data-version", "data"),
     Input("data-refresh-interval-component", "n_intervals"),
-    prevent_initial_call=True,
+    State("data-version", "data"),
 )
-def data_refresh_interval(n):
+def data_refresh_interval(n, version):
     '''
-    This callback does something at regular intervals.
+    This callback signals a refresh when a new snapshot has been published since the page loaded (or last refreshed).
+    The version is heard by the server's subscriber, so this check doesn't touch Redis. 
     '''
-    return n
+    latest_version = db.get_latest_version(r)
+
+    # the page's first load already shows the latest snapshot
+    if version is None:
+        return dash.no_update, latest_version
+    if latest_version == version:
+        return dash.no_update, dash.no_update
+    return latest_version, latest_version
 
 ### --> <-- ###
 
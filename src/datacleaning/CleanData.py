@@ -1,3 +1,5 @@
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from sklearn.pipeline import Pipeline
 import datacleaning.fullcleaningclasses as fcc
 import datacleaning.todaysessioncleaningclasses as scc
@@ -13,64 +15,123 @@ class CleanData:
         pass
 
     @staticmethod
-    def clean_raw_data(raw_data) -> dict:
+    def get_dirty_start(fivemindemand: pd.DataFrame, new_data: pd.DataFrame) -> pd.Timestamp:
         """
-        This function cleans raw data slrpEV data and returns six cleaned dataframes in a dictionary with keys:
-        `fivemindemand`, `hourlydemand`, `dailydemand`, `monthlydemand`, `todays_sessions`, `raw_data`, `raw_data_subset`.
+        This function returns the earliest 5-min time a previously cleaned `fivemindemand` can no longer be trusted from, 
+        given the new/changed raw records since it was cleaned. That's the earliest (rounded) start of a changed session, 
+        or the last time cleaned, whichever is first, since the tail of `fivemindemand` was only imputed up to then. 
         """
+        dirty_start = fivemindemand.index[-1]
 
-        # raw data pipeline (adds helper columns)
-        raw_data_pipeline = Pipeline(
+        changed_start = new_data["startChargeTime"].dt.round("5min").min()
+        if not pd.isna(changed_start):
+            dirty_start = min(dirty_start, changed_start)
+
+        return dirty_start
+
+    @staticmethod
+    def run_branches(branch_pipelines: dict, X: pd.DataFrame, max_workers: int = None, processes: bool = False, inputs: dict = None) -> dict:
+        """
+        This function runs independent pipelines on the same input and returns their outputs by name. 
+        With `max_workers` greater than one, pipelines run concurrently on a thread pool, or a process pool if `processes`.
+        Pipelines named in `inputs` run on their own input instead.
+        """
+        inputs = {} if inputs is None else inputs
+        if max_workers is None or max_workers <= 1:
+            return {name: pipeline.fit_transform(inputs.get(name, X)) for name, pipeline in branch_pipelines.items()}
+
+        executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with executor_class(max_workers=max_workers) as executor:
+            futures = {name: executor.submit(pipeline.fit_transform, inputs.get(name, X)) for name, pipeline in branch_pipelines.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    @staticmethod
+    def partition_chargers(chargers: pd.DataFrame) -> dict:
+        """
+        This function splits the charger states of every site into one dataframe per site, with keys `chargers_{siteId}`. 
+        """
+        return {f"chargers_{site_id}": site_chargers.reset_index(drop=True) for site_id, site_chargers in chargers.groupby("siteId")}
+
+    @staticmethod
+    def get_todays_sessions_pipeline() -> Pipeline:
+        """
+        This function returns the pipeline cleaning today's sessions out of raw slrpEV data. Records are filtered to today 
+        before anything else, so sorting, helper columns and the nested time series only run on today's sessions.
+        """
+        return Pipeline(
             [
+                ("filter_today_records", scc.FilterTodayRecords()),
                 ("sort_drop_cast", fcc.SortDropCast()),
                 ("create_helpers", fcc.HelperFeatureCreation()),
+                ("filter_today", scc.FilterTodaySessions()),
+                ("nested_ts", scc.CreateNestedSessionTimeSeries()),
             ]
         )
-        raw_data_w_helpers = raw_data_pipeline.fit_transform(raw_data)
 
-        # subset of raw data pipeline (only some columns for query optimization)
-        subset_raw_data_pipeline = Pipeline(
-            [
-                ("subset_columns", fcc.CreateSubsets(["connectTime", "userId", "cumEnergy_Wh", "DurationHrs", "choice"])), 
-            ]
-        )
-        raw_data_subset = subset_raw_data_pipeline.fit_transform(raw_data_w_helpers)
+    @classmethod
+    def clean_todays_sessions(cls, raw_data: pd.DataFrame) -> pd.DataFrame:
+        """
+        This function cleans today's sessions out of raw slrpEV data (see `get_todays_sessions_pipeline`).
+        """
+        return cls.get_todays_sessions_pipeline().fit_transform(raw_data)
 
-        # chargers pipeline 
-        chargers_pipeline = Pipeline(
-            [
-                ("clean_chargers", ccc.CleanChargers())
-            ]
-        )
-        chargers = chargers_pipeline.fit_transform(raw_data_w_helpers)
+    @classmethod
+    def clean_raw_data(cls, raw_data, previous: dict = None, new_data: pd.DataFrame = None, max_workers: int = None, processes: bool = False) -> dict:
+        """
+        This function cleans raw data slrpEV data and returns the cleaned dataframes in a dictionary with keys:
+        `fivemindemand`, `hourlydemand`, `dailydemand`, `monthlydemand`, `hoverdistributions`, `todays_sessions`, `raw_data`, 
+        `raw_data_subset`, and a `chargers_{siteId}` for each site. 
+        If the previously cleaned dataframes (`previous`) and the raw records new/changed since (`new_data`) are given, 
+        `fivemindemand` and its granularities are only recomputed from the earliest time the changes touch, 
+        and spliced onto the previous ones.
+        Branches after the shared helper columns run on `max_workers` threads (or processes, if `processes`). 
+        """
+        # incremental cleaning window; `None` cleans the whole history
+        previous_fivemindemand = previous["fivemindemand"] if previous is not None and new_data is not None else None
+        dirty_start = cls.get_dirty_start(previous_fivemindemand, new_data) if previous_fivemindemand is not None else None
 
-        # full time series pipeline; you could also pass `raw_data_w_helpers` here but showing full pipeline for clarity
-        full_ts_pipeline = Pipeline(
+        # shared pipeline (sorts, drops, and adds helper columns); every branch below starts from its output
+        shared_pipeline = Pipeline(
             [
                 ("sort_drop_cast", fcc.SortDropCast()),
                 ("create_helpers", fcc.HelperFeatureCreation()),
-                ("create_session_ts", fcc.CreateSessionTimeSeries()),
-                ("impute_zero", fcc.ImputeZero()),
-                ("create_features", fcc.FeatureCreation()),
-                ("create_granularities", fcc.CreateGranularities()),
             ]
         )
-        # fivemindemand, hourlydemand, dailydemand, monthlydemand are keys here
-        cleaned_dataframes = full_ts_pipeline.fit_transform(raw_data)
+        raw_data_w_helpers = shared_pipeline.fit_transform(raw_data)
 
-        # today's sessions pipeline
-        todays_sessions_pipeline = Pipeline(
-            [
-                ("sort_drop_cast", scc.SortDropCastSessions()),
-                ("create_helpers", scc.HelperFeatureCreation()),
-                ("nested_ts", scc.CreateNestedSessionTimeSeries()),
-            ]
-        )
-        cleaned_dataframes["todays_sessions"] = todays_sessions_pipeline.fit_transform(raw_data)
+        # branches; none of them modify their input, so they can all share `raw_data_w_helpers`
+        branch_pipelines = {
+            # subset of raw data (only some columns for query optimization)
+            "raw_data_subset": Pipeline(
+                [
+                    ("subset_columns", fcc.CreateSubsets(["connectTime", "userId", "cumEnergy_Wh", "DurationHrs", "choice"])), 
+                ]
+            ),
+            # chargers
+            "chargers": Pipeline(
+                [
+                    ("clean_chargers", ccc.CleanChargers())
+                ]
+            ),
+            # full time series; fivemindemand, hourlydemand, dailydemand, monthlydemand, hoverdistributions are keys of its output
+            "full_ts": Pipeline(
+                [
+                    ("create_session_ts", fcc.CreateSessionTimeSeries(since=dirty_start)),
+                    ("impute_zero", fcc.ImputeZero()),
+                    ("create_features", fcc.FeatureCreation()),
+                    ("splice_previous", fcc.SpliceTimeSeries(previous_fivemindemand)),
+                    ("create_granularities", fcc.CreateGranularities(previous=previous if dirty_start is not None else None, since=dirty_start)),
+                    ("create_distributions", fcc.CreateHoverDistributions()),
+                ]
+            ),
+            # today's sessions; filtered out of the raw data first, so they don't need the shared pipeline's output
+            "todays_sessions": cls.get_todays_sessions_pipeline(),
+        }
+        branch_results = cls.run_branches(branch_pipelines, raw_data_w_helpers, max_workers, processes, inputs={"todays_sessions": raw_data})
 
-        # raw data, raw data subset, and chargers
+        cleaned_dataframes = branch_results.pop("full_ts")
+        cleaned_dataframes.update(cls.partition_chargers(branch_results.pop("chargers")))
+        cleaned_dataframes.update(branch_results)
         cleaned_dataframes["raw_data"] = raw_data_w_helpers
-        cleaned_dataframes["raw_data_subset"] = raw_data_subset
-        cleaned_dataframes["chargers"] = chargers
 
         return cleaned_dataframes
@@ -1,6 +1,8 @@
 import os
+import numpy as np
 import pandas as pd
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 from boto3.dynamodb.conditions import Key, Attr
 from dotenv import load_dotenv
 
@@ -11,6 +13,38 @@ class FetchData:
     """
 
     table_id = "Sessions2"
+    key_column = "dcosId"
+    watermark_column = "lastUpdate"
+    # records are re-fetched from this far before the high-water mark; the table is written while it's scanned, 
+    # so a scan can see a later write but miss an earlier one, which would otherwise never be fetched again
+    watermark_lookback = pd.Timedelta(minutes=16)
+    scan_segments = 8 # segments for a full (cold start) scan
+
+    timestamp_format = "%Y-%m-%d %H:%M:%S" # format of the time attributes in DynamoDB
+    archive_dir = "data/archive" # local archive of raw sessions, one partition per `connectTime` month
+    archive_partition_column = "connectTime"
+
+    # every attribute read by the cleaning pipelines (`fullcleaningclasses`, `todaysessioncleaningclasses`, 
+    # `chargercleaningclasses`) and the pages that load `raw_data`, with the dtype it's decoded to; 
+    # nothing else is transferred
+    schema = {
+        "dcosId": "Int64",
+        "siteId": "Int64",
+        "stationId": "Int64",
+        "userId": "Int64",
+        "vehicle_model": "object",
+        "choice": "object",
+        "connectTime": "datetime64[ns]",
+        "startChargeTime": "datetime64[ns]",
+        "Deadline": "datetime64[ns]",
+        "lastUpdate": "datetime64[ns]",
+        "Duration": "object",
+        "DurationHrs": "float64",
+        "cumEnergy_Wh": "float64",
+        "peakPower_W": "float64",
+        "sch_centsPerHr": "float64",
+        "reg_centsPerHr": "float64",
+    }
 
     def __init__(self):
         pass
@@ -18,41 +52,273 @@ class FetchData:
     @classmethod
     def __get_table(cls, table_id: str):
         """
-        This function returns a specified table from AWS DyanamoDB. 
+        This function returns a specified table from AWS DyanamoDB. The table is built from a new session, 
+        since creating resources from boto3's shared default session on several threads at once isn't safe.
         """
         load_dotenv() # load environment variables
-        dynamodb = boto3.resource(
+        dynamodb = boto3.session.Session().resource(
             "dynamodb",
             aws_access_key_id=os.getenv("ACCESS_KEY_ID"),
             aws_secret_access_key=os.getenv("SECRET_ACCESS_KEY"),
             region_name="us-east-2",
+            endpoint_url=os.getenv("DYNAMODB_ENDPOINT_URL"), # unset in production, set to point at a local DynamoDB
         )
         return dynamodb.Table(table_id)
 
 
     @classmethod
-    def scan_all_records(cls) -> pd.DataFrame:
+    def __get_projection(cls) -> dict:
+        """
+        This function returns the scan parameters that limit each item to the attributes in `schema`. 
+        Every attribute is aliased, since some names (e.g. `Duration`) are DynamoDB reserved words.
+        """
+        aliases = {f"#c{idx}": column for idx, column in enumerate(cls.schema)}
+        return {
+            "ProjectionExpression": ", ".join(aliases.keys()),
+            "ExpressionAttributeNames": aliases,
+        }
+
+
+    @staticmethod
+    def __decode_column(values: list, dtype: str):
+        """
+        This function decodes one attribute of a page of items into a typed array. 
+        DynamoDB numbers arrive as `Decimal`, missing attributes as `None`.
+        """
+        if dtype == "float64":
+            return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+        elif dtype == "Int64":
+            return pd.array([None if value is None else int(value) for value in values], dtype="Int64")
+        elif dtype == "datetime64[ns]":
+            return pd.to_datetime(pd.Series(values, dtype=object)).to_numpy()
+        return np.array(values, dtype=object)
+
+
+    @classmethod
+    def __decode_page(cls, items: list) -> dict:
+        """
+        This function decodes a page of scanned items into a dictionary of typed column arrays, following `schema`. 
+        """
+        return {column: cls.__decode_column([item.get(column) for item in items], dtype) for column, dtype in cls.schema.items()}
+
+
+    @classmethod
+    def __build_dataframe(cls, pages: list) -> pd.DataFrame:
+        """
+        This function stitches decoded pages together, column by column, into a typed dataframe. 
+        """
+        if not pages:
+            return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in cls.schema.items()})
+
+        return pd.DataFrame({
+            column: pd.concat([pd.Series(page[column], dtype=dtype) for page in pages], ignore_index=True) 
+            for column, dtype in cls.schema.items()
+        })
+
+
+    @classmethod
+    def __scan(cls, **scan_kwargs) -> list:
         """
-        This function scans all the slrpEV records from from AWS DynamoDB. 
-        Result is returned as a pandas dataframe.
+        This function pages through a scan of the slrpEV table, passing `scan_kwargs` to every request.
+        Only the attributes in `schema` are requested, and each page is decoded as soon as it arrives. 
+        Result is returned as a list of decoded pages.
         """
         scan_results = []
-        table = cls.__get_table(cls.table_id)
+        table = cls.__get_table(cls.table_id) # boto3 sessions and resources aren't thread safe, so one per call (and thread)
 
         done = False
         start_key = None
-        params = {}
+        params = {**cls.__get_projection(), **scan_kwargs}
 
         while not done:
             if start_key is not None:
-                params = {"ExclusiveStartKey": start_key}
+                params["ExclusiveStartKey"] = start_key
 
             response = table.scan(**params)
-            scan_results.extend(response.get("Items", []))
+            if response.get("Items"):
+                scan_results.append(cls.__decode_page(response["Items"]))
 
             start_key = response.get("LastEvaluatedKey", None)
             done = start_key is None
 
-        raw_data = pd.json_normalize(scan_results)
+        return scan_results
+
+
+    @classmethod
+    def __parallel_scan(cls, segments: int, max_workers: int = None, **scan_kwargs) -> list:
+        """
+        This function splits a scan into `segments` DynamoDB segments, scanned concurrently by a thread pool 
+        of `max_workers` threads (one per segment by default). Pages are returned in segment order, so the
+        result doesn't depend on which segment finishes first.
+        """
+        if segments <= 1:
+            return cls.__scan(**scan_kwargs)
+
+        with ThreadPoolExecutor(max_workers=max_workers or segments) as executor:
+            segment_results = executor.map(
+                lambda segment: cls.__scan(Segment=segment, TotalSegments=segments, **scan_kwargs),
+                range(segments)
+            )
+            scan_results = [page for segment_result in segment_results for page in segment_result]
+
+        return scan_results
+
+
+    @classmethod
+    def scan_all_records(cls, segments: int = None, max_workers: int = None) -> pd.DataFrame:
+        """
+        This function scans all the slrpEV records from from AWS DynamoDB. The table is scanned 
+        in `segments` parallel segments (`scan_segments` by default) by `max_workers` threads. 
+        Result is returned as a pandas dataframe, typed according to `schema`.
+        """
+        segments = cls.scan_segments if segments is None else segments
+        raw_data = cls.__build_dataframe(cls.__parallel_scan(segments, max_workers))
         
         return raw_data
+
+
+    @classmethod
+    def scan_new_records(cls, watermark: str, segments: int = None, max_workers: int = None) -> pd.DataFrame:
+        """
+        This function scans the slrpEV records with a `lastUpdate` at or after `watermark`. DynamoDB still 
+        pages through the whole table to apply the filter, so this scan is split into segments as well.
+        Result is returned as a pandas dataframe, typed according to `schema`.
+        """
+        segments = cls.scan_segments if segments is None else segments
+        new_data = cls.__build_dataframe(cls.__parallel_scan(segments, max_workers, FilterExpression=Attr(cls.watermark_column).gte(watermark)))
+
+        return new_data
+
+
+    @classmethod
+    def get_watermark(cls, raw_data: pd.DataFrame, lookback: pd.Timedelta = None) -> str:
+        """
+        This function returns the high-water mark of a raw dataframe, the largest `lastUpdate` seen 
+        (less `lookback`, if given), formatted the way DynamoDB stores it.
+        """
+        watermark = pd.to_datetime(raw_data[cls.watermark_column]).max()
+        if lookback is not None:
+            watermark = watermark - lookback
+        return watermark.strftime(cls.timestamp_format)
+
+
+    @classmethod
+    def get_records_since(cls, raw_data: pd.DataFrame, watermark: str, lookback: pd.Timedelta = None) -> pd.DataFrame:
+        """
+        This function returns the records of a raw dataframe with a `lastUpdate` at or after `watermark` (less `lookback`, if given).
+        """
+        watermark = pd.to_datetime(watermark)
+        if lookback is not None:
+            watermark = watermark - lookback
+        return raw_data[pd.to_datetime(raw_data[cls.watermark_column]) >= watermark]
+
+
+    @classmethod
+    def merge_records(cls, raw_data: pd.DataFrame, new_data: pd.DataFrame) -> pd.DataFrame:
+        """
+        This function merges newly fetched records into a previously fetched raw dataframe. 
+        Sessions are matched on `dcosId`, and the newer copy of a session is kept. 
+        Columns outside of `schema` (e.g. from frames fetched before projection) are dropped, and the 
+        rest are cast to their `schema` dtype (a no-op for frames that were already decoded).
+        """
+        raw_data = raw_data[raw_data.columns.intersection(list(cls.schema))]
+        raw_data = raw_data.astype({column: cls.schema[column] for column in raw_data.columns})
+
+        if new_data.empty:
+            return raw_data
+
+        merged = pd.concat([raw_data, new_data], axis=0, ignore_index=True)
+        merged = merged.drop_duplicates(subset=cls.key_column, keep="last").reset_index(drop=True)
+
+        return merged
+
+
+    @classmethod
+    def fetch_incremental(cls, raw_data: pd.DataFrame = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        This function fetches only the records updated since the high-water mark of `raw_data` (less `watermark_lookback`) 
+        and merges them in. If there is no previous raw dataframe, every record is scanned. 
+        Returns the merged raw dataframe and the new/changed records, in that order.
+        """
+        if raw_data is None or raw_data.empty:
+            raw_data = cls.scan_all_records()
+            return raw_data, raw_data
+
+        # re-fetching the sessions in the lookback window is harmless, they're deduplicated on merge
+        new_data = cls.scan_new_records(cls.get_watermark(raw_data, cls.watermark_lookback))
+        raw_data = cls.merge_records(raw_data, new_data)
+
+        return raw_data, new_data
+
+
+    @classmethod
+    def __get_partition(cls, month: str, archive_dir: str) -> str:
+        """
+        This function returns the path of the archive partition for a month in 'yyyy-mm' format.
+        """
+        return os.path.join(archive_dir, f"month={month}", "sessions.parquet")
+
+
+    @classmethod
+    def archive_records(cls, new_data: pd.DataFrame, archive_dir: str = None) -> None:
+        """
+        This function writes a batch of fetched records to the local Parquet archive, partitioned by `connectTime` month.
+        Records are merged into their month's partition like `merge_records`, so re-archiving a session replaces it. 
+        Each partition is written to a temporary file and then swapped in, so a crash never leaves a partial partition.
+        Sessions without a `connectTime` go to the `undated` partition.
+        """
+        archive_dir = cls.archive_dir if archive_dir is None else archive_dir
+        months = new_data[cls.archive_partition_column].dt.strftime("%Y-%m").fillna("undated")
+
+        for month, batch in new_data.groupby(months):
+            path = cls.__get_partition(month, archive_dir)
+
+            if os.path.exists(path):
+                batch = cls.merge_records(pd.read_parquet(path), batch)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            batch.to_parquet(path + ".tmp", index=False)
+            os.replace(path + ".tmp", path)
+
+
+    @classmethod
+    def load_archive(cls, start: str = None, end: str = None, archive_dir: str = None) -> pd.DataFrame:
+        """
+        This function reads raw records from the local Parquet archive with a `connectTime` between `start` and `end`. 
+        If any argument is None, function will ignore those bounds. Only partitions for months overlapping the range are read.
+        Result is returned as a pandas dataframe, typed according to `schema`.
+        ~~~
+        Parameters:
+        start : Inclusive start date in 'yyyy-mm-dd' format.
+        end : Inclusive end date in 'yyyy-mm-dd' format.
+        archive_dir : Archive location, `archive_dir` by default.
+        """
+        archive_dir = cls.archive_dir if archive_dir is None else archive_dir
+        start_month = pd.to_datetime(start).strftime("%Y-%m") if start is not None else None
+        end_month = pd.to_datetime(end).strftime("%Y-%m") if end is not None else None
+
+        partitions = []
+        if os.path.isdir(archive_dir):
+            for partition in sorted(os.listdir(archive_dir)):
+                month = partition.removeprefix("month=")
+                # undated sessions only belong to unbounded reads
+                if month == "undated" and (start is not None or end is not None):
+                    continue
+                if month != "undated" and ((start_month is not None and month < start_month) or (end_month is not None and month > end_month)):
+                    continue
+                if os.path.exists(cls.__get_partition(month, archive_dir)):
+                    partitions.append(pd.read_parquet(cls.__get_partition(month, archive_dir)))
+
+        if not partitions:
+            return cls.__build_dataframe([])
+
+        raw_data = pd.concat(partitions, axis=0, ignore_index=True)
+
+        if start is not None:
+            raw_data = raw_data.loc[raw_data[cls.archive_partition_column] >= pd.to_datetime(start)]
+        if end is not None:
+            # inclusive of the whole end day
+            raw_data = raw_data.loc[raw_data[cls.archive_partition_column] < pd.to_datetime(end) + pd.Timedelta(days=1)]
+
+        return raw_data.reset_index(drop=True)
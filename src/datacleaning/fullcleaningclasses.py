@@ -1,23 +1,22 @@
 from sklearn.base import BaseEstimator, TransformerMixin
 import pandas as pd
+import numpy as np
 import pytz
 from datetime import datetime
 
 
 class SortDropCast(BaseEstimator, TransformerMixin):
     """
-    This pipeline step will sort values by field `connectTime`,
-    drop columns `user_email`, `slrpPaymentId`, 
-    and cast columns `cumEnergy_Wh`, `peakPower_W` as float values. 
+    This pipeline step will sort values by field `connectTime`, and
+    drop columns `user_email`, `slrpPaymentId` (if they were fetched). 
+    Columns already arrive typed from `FetchData`, so nothing is cast here. 
     """
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X) -> pd.DataFrame:
-        X = X.sort_values(by="connectTime").drop(columns=["user_email", "slrpPaymentId"]).reset_index(drop=True)
-        X["cumEnergy_Wh"] = X["cumEnergy_Wh"].astype(float)
-        X["peakPower_W"] = X["peakPower_W"].astype(float)
+        X = X.sort_values(by="connectTime").drop(columns=["user_email", "slrpPaymentId"], errors="ignore").reset_index(drop=True)
         return X
 
 
@@ -37,15 +36,9 @@ class HelperFeatureCreation(BaseEstimator, TransformerMixin):
         # filter out rows where peakPower_W and cumEnergy_Wh contain bad (0) values
         X = X.loc[(X["peakPower_W"] != 0) & (X["cumEnergy_Wh"] != 0)].copy(deep=True)
 
-        # cast dates to pandas datetime
-        X["connectTime"] = pd.to_datetime(X["connectTime"])
-        X["startChargeTime"] = pd.to_datetime(X["startChargeTime"])
-        X["Deadline"] = pd.to_datetime(X["Deadline"])
-        X["lastUpdate"] = pd.to_datetime(X["lastUpdate"])
-
         X["finishChargeTime"] = X["lastUpdate"] 
         # `cumEnergy_Wh` & `DurationHrs` are seen as columns of truth
-        X["true_peakPower_W"] = round(X["cumEnergy_Wh"] / X["DurationHrs"].astype(float), 0)
+        X["true_peakPower_W"] = round(X["cumEnergy_Wh"] / X["DurationHrs"], 0)
 
         # filter out bad rows (this occurs when there is a very low peak power and high energy delivered)
         # also filter out excessively high duration from raw data
@@ -88,28 +81,52 @@ class HelperFeatureCreation(BaseEstimator, TransformerMixin):
 class CreateSessionTimeSeries(BaseEstimator, TransformerMixin):
     """
     This pipeline step will create a time series for each session. A dataframe
-    with 5-min granularity will be returned, with one column, `power_demand_W`.
+    with 5-min granularity will be returned, with one column, `avg_power_demand_W`.
+    Sessions are never expanded one by one; each session adds its power to a difference array
+    at its first 5-min bin and removes it after its last, and a cumulative sum gives the demand. 
+    If `since` is given, only the time series from `since` onwards is created, from the sessions overlapping it. 
     """
 
+    step = np.timedelta64(5, "m")
+
+    def __init__(self, since=None) -> None:
+        self.since = since
+        super().__init__()
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X) -> pd.DataFrame:
-        self.rows = []
-        X.apply(self.__create_ts, axis=1)
-        X = pd.concat(self.rows, axis=0).sort_index()
-        X = X.resample("5min").sum()
-        return X
-
-    def __create_ts(self, session: pd.Series):
-        """
-        This helper function takes in a session, with a `connectTime`, `finishChargeTime`, and 
-        a `peakPower_W` column. Function will return a time series at 5-min granularity. 
-        """
-        date_range = pd.date_range(start=session["startChargeTime"].round("5min"), end=session["finishChargeTime"].round("5min"), freq="5min")
-        temp_df = pd.DataFrame(index=date_range)
-        temp_df["avg_power_demand_W"] = session["true_peakPower_W"]  # rename
-        self.rows.append(temp_df)
+        # a session occupies every 5-min bin from its rounded start to its rounded finish, inclusive
+        starts = X["startChargeTime"].dt.round("5min")
+        finishes = X["finishChargeTime"].dt.round("5min")
+        valid = (finishes >= starts).to_numpy()
+        if self.since is not None:
+            valid &= (finishes >= self.since).to_numpy()
+        starts, finishes = starts.to_numpy()[valid], finishes.to_numpy()[valid]
+
+        if len(starts) == 0 and self.since is None:
+            return pd.DataFrame(columns=["avg_power_demand_W"], index=pd.DatetimeIndex([], freq="5min"), dtype=float)
+
+        # sessions without a usable power add nothing, like a missing value in a sum
+        power = X["true_peakPower_W"].to_numpy(dtype=float)[valid]
+        power = np.where(np.isfinite(power), power, 0)
+
+        # sessions that started before `since` are clipped to it
+        origin = starts.min() if self.since is None else np.datetime64(pd.Timestamp(self.since), "ns")
+        first_bins = np.maximum((starts - origin) // self.step, 0)
+        last_bins = (finishes - origin) // self.step
+        num_bins = max(last_bins.max() + 1, 1) if len(last_bins) else 1
+
+        # `true_peakPower_W` is rounded to whole watts, so the running sum is exact
+        diff = np.zeros(num_bins + 1)
+        np.add.at(diff, first_bins, power)
+        np.add.at(diff, last_bins + 1, -power)
+
+        return pd.DataFrame(
+            {"avg_power_demand_W": np.cumsum(diff[:-1])}, 
+            index=pd.date_range(start=origin, periods=num_bins, freq="5min")
+        )
 
 
 class ImputeZero(BaseEstimator, TransformerMixin):
@@ -165,6 +182,27 @@ class FeatureCreation(BaseEstimator, TransformerMixin):
         X["month"] = X.index.month_name()
         return X
     
+class SpliceTimeSeries(BaseEstimator, TransformerMixin):
+    """
+    This pipeline step splices a recomputed window of a 5-min time series onto the end of a 
+    previously cleaned one. Everything in `previous` from the start of the window onwards is replaced. 
+    If there is no previous time series, the window is returned as is. 
+    """
+
+    def __init__(self, previous=None) -> None:
+        self.previous = previous
+        super().__init__()
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X) -> pd.DataFrame:
+        if self.previous is None or len(X) == 0:
+            return X
+
+        return pd.concat([self.previous.loc[self.previous.index < X.index[0]], X], axis=0)
+
+
 class CreateSubsets(BaseEstimator, TransformerMixin):
     """
     This pipeline step will subset the dataframe to only certain columns.
@@ -185,10 +223,12 @@ class CreateGranularities(BaseEstimator, TransformerMixin):
     """
     This pipeline step takes each dataframe and creates new granularities--hourly, daily, and monthly.
     Returns a dictionary with all dataframes with keys: `fivemindemand`, `hourlydemand`, `dailydemand`, and `monthlydemand`.
+    If the previous granularities (`previous`) and the earliest time the 5-min data changed (`since`) are given, 
+    only the hours, days, and months from `since` onwards are re-aggregated and spliced onto the previous ones.
     Each dataframe is optionally saved to a `data/` file. 
     """
 
-    def __init__(self, save=False) -> None:
+    def __init__(self, save=False, previous=None, since=None) -> None:
         self.agg_key = {
             "avg_power_demand_kW": "mean",
             "energy_demand_kWh": "sum",
@@ -202,7 +242,15 @@ class CreateGranularities(BaseEstimator, TransformerMixin):
             "dailydemand",
             "monthlydemand"
         ]
+        # resampling rule and period for each new granularity
+        self.granularities = {
+            "hourlydemand": ("1H", "H"),
+            "dailydemand": ("1D", "D"),
+            "monthlydemand": ("M", "M"),
+        }
         self.save = save
+        self.previous = previous
+        self.since = since
         super().__init__()
 
     def fit(self, X, y=None):
@@ -210,16 +258,9 @@ class CreateGranularities(BaseEstimator, TransformerMixin):
 
     def transform(self, X) -> dict:
         # create new granularities
-        hourlydemand = X.resample("1H").agg(self.agg_key)
-        dailydemand = X.resample("1D").agg(self.agg_key)
-        monthlydemand = X.resample("M").agg(self.agg_key)
-
-        new_dataframes = {
-            "fivemindemand": X,
-            "hourlydemand": hourlydemand,
-            "dailydemand": dailydemand,
-            "monthlydemand": monthlydemand
-        }
+        new_dataframes = {"fivemindemand": X}
+        for name, (rule, period) in self.granularities.items():
+            new_dataframes[name] = self.__resample(X, name, rule, period)
 
         # save to file system
         if self.save:
@@ -227,3 +268,85 @@ class CreateGranularities(BaseEstimator, TransformerMixin):
                 dataframe.to_csv(f"data/{self.dataframe_names[idx]}.csv")
 
         return new_dataframes
+
+    def __resample(self, X, name: str, rule: str, period: str) -> pd.DataFrame:
+        """
+        This helper function resamples the 5-min data to one granularity. If there's a previous dataframe
+        for the granularity, only the buckets from the one containing `since` onwards are resampled; 
+        they're aggregated from the 5-min data again, so the result is exact. 
+        """
+        if self.previous is None or self.since is None or name not in self.previous:
+            return X.resample(rule).agg(self.agg_key)
+
+        bucket_start = pd.Timestamp(self.since).to_period(period).start_time
+        recomputed = X.loc[X.index >= bucket_start].resample(rule).agg(self.agg_key)
+        previous = self.previous[name]
+
+        if len(recomputed) == 0:
+            return previous
+
+        return pd.concat([previous.loc[previous.index < recomputed.index[0]], recomputed], axis=0)
+
+
+class CreateHoverDistributions(BaseEstimator, TransformerMixin):
+    """
+    This pipeline step takes the dictionary of granularities (see `CreateGranularities`) and adds `hoverdistributions`, 
+    the distributions the hover histograms show: each quantity of `dailydemand` per day of the week, and of `hourlydemand` 
+    per hour of the day, binned. The dataframe has one row per bin, with columns `distribution` (`day` or `hour`), `quantity`, 
+    `key` (the day name, or hour), `bin_start`, `bin_end`, and `percent` (share of the values in the bin).
+    """
+
+    def __init__(self, max_bins=40) -> None:
+        self.quantities = [
+            "energy_demand_kWh",
+            "avg_power_demand_kW",
+            "peak_power_kW"
+        ]
+        self.max_bins = max_bins
+        super().__init__()
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X) -> dict:
+        dailydemand, hourlydemand = X["dailydemand"], X["hourlydemand"]
+
+        distributions = pd.concat(
+            [
+                self.__bin(dailydemand, "day", dailydemand["day"]),
+                self.__bin(hourlydemand, "hour", hourlydemand.index.hour.astype(str)),
+            ], 
+            ignore_index=True
+        )
+
+        return {**X, "hoverdistributions": distributions}
+
+    def __bin(self, df: pd.DataFrame, distribution: str, keys) -> pd.DataFrame:
+        """
+        This helper function bins every quantity of `df` per value of `keys`. Bins are picked by numpy's `auto` 
+        rule, but there are at most `max_bins` of them. 
+        """
+        binned = []
+        for quantity in self.quantities:
+            for key, values in df[quantity].groupby(keys):
+                values = values.dropna().to_numpy()
+                if len(values) == 0:
+                    continue
+
+                edges = np.histogram_bin_edges(values, bins="auto")
+                if len(edges) > self.max_bins + 1:
+                    edges = np.histogram_bin_edges(values, bins=self.max_bins)
+                counts, edges = np.histogram(values, bins=edges)
+
+                binned.append(pd.DataFrame({
+                    "distribution": distribution,
+                    "quantity": quantity,
+                    "key": key,
+                    "bin_start": edges[:-1],
+                    "bin_end": edges[1:],
+                    "percent": counts / len(values) * 100,
+                }))
+
+        if not binned:
+            return pd.DataFrame(columns=["distribution", "quantity", "key", "bin_start", "bin_end", "percent"])
+        return pd.concat(binned, ignore_index=True)
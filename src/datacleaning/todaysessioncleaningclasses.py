@@ -5,44 +5,25 @@ import pytz
 from datetime import datetime, timedelta
 
 
-class SortDropCastSessions(BaseEstimator, TransformerMixin):
+class FilterTodayRecords(BaseEstimator, TransformerMixin):
     """
-    This pipeline step will sort values by field `connectTime`,
-    drop columns `user_email`, `slrpPaymentId`, 
-    and cast columns `cumEnergy_Wh`, `peakPower_W` as float values.
-    This pipeline step will drop any records that contain 0 for 
-    `peakPower_W` or `cumEnergy_Wh`. 
-    Time-based columns will be converted into pandas timedate-like.
+    This pipeline step takes the raw data and keeps only the records last updated today. A session's `finishChargeTime` 
+    is its `lastUpdate` (see `fullcleaningclasses.HelperFeatureCreation`), so these are exactly the sessions finishing today, 
+    and every later step only has to touch today's handful of sessions instead of the whole history.
     """
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X) -> pd.DataFrame:
+        return X[X["lastUpdate"] >= datetime.now(pytz.timezone('US/Pacific')).strftime("%D")]
 
-        X["cumEnergy_Wh"] = X["cumEnergy_Wh"].astype(float)
-        X["peakPower_W"] = X["peakPower_W"].astype(float)
-        X["userId"] = X["userId"].astype(str)
-
-        X["connectTime"] = pd.to_datetime(X["connectTime"])
-        X["startChargeTime"] = pd.to_datetime(X["startChargeTime"])
-        X["Deadline"] = pd.to_datetime(X["Deadline"])
-        X["lastUpdate"] = pd.to_datetime(X["lastUpdate"])
-
-        X = X.loc[(X["peakPower_W"] != 0) & (X["cumEnergy_Wh"] != 0)].copy()
-
-        X = X.sort_values(by="connectTime").drop(columns=["user_email", "slrpPaymentId"]).reset_index(drop=True)
-
-        return X
 
-
-class HelperFeatureCreation(BaseEstimator, TransformerMixin):
+class FilterTodaySessions(BaseEstimator, TransformerMixin):
     """
-    This pipeline step will drop any records that contain 0 for 
-    `peakPower_W` or `cumEnergy_Wh`. Four additional columns will be created:
-    `finishChargeTime`, `true_peakPower_W`, `Overstay`, and `Overstay_h`. 
-    Any records with calculated charging durations greater than a day will be dropped. 
-    This step accounts for inconsistencies in the slrpEV data. 
+    This pipeline step takes the raw data with helpers (see `fullcleaningclasses.HelperFeatureCreation`)
+    and keeps only the sessions finishing today. Sessions lasting two days or more are dropped, and 
+    column `userId` is cast as strings.
     """
 
     def fit(self, X, y=None):
@@ -50,49 +31,21 @@ class HelperFeatureCreation(BaseEstimator, TransformerMixin):
 
     def transform(self, X) -> pd.DataFrame:
 
-        X["finishChargeTime"] = X["lastUpdate"]
-        X["true_peakPower_W"] = round(X["cumEnergy_Wh"] / X["DurationHrs"].astype(float), 0)
-
-        X = X[X["finishChargeTime"] >= datetime.now(pytz.timezone('US/Pacific')).strftime("%D")].copy()
+        X = X[X["finishChargeTime"] >= datetime.now(pytz.timezone('US/Pacific')).strftime("%D")]
 
-        # filter out bad rows (this occurs when there is a very low peak power and high energy delivered). also filter out excessively high duration from raw data
-        X = X.loc[X["DurationHrs"] <= 24].copy()
-        X = X[~(X["Duration"].str[0].astype(int) >= 2)]
+        # filter out excessively long sessions
+        X = X[~(X["Duration"].str[0].astype(int) >= 2)].copy()
 
-        X['temp_0'] = pd.Timedelta(days=0, seconds=0)
-        X['Overstay'] = X["lastUpdate"] - X['Deadline']
-        X["Overstay"] = X[["Overstay", "temp_0"]].max(axis=1)
-        X['Overstay_h'] = X['Overstay'].dt.seconds / 3600
-        X.drop(columns=['temp_0'], inplace=True)
+        X["userId"] = X["userId"].astype(str)
 
         return X
 
-    @staticmethod
-    def __get_duration(row):
-        """
-        This helper function calculates the charging duration of a session. 
-        The calculation is `lastUpdate - startChargeTime`. 
-        """
-        return round(((row["lastUpdate"] - row["startChargeTime"]).seconds/3600), 3)
-
-    @staticmethod
-    def __get_finishChargeTime(row):
-        """
-        This helper function calculates the finished charge time of a session. If the session is `REGULAR`, 
-        the finish charge time is `lastUpdate`. If the session is `SCHEDULED`, the finish charge time is `Deadline`.
-        DEPRECATED: Currently, every session finishes at `lastUpdate` becaused SCHEDULED sessions can end early.
-        """        
-        if row["regular"] == 1:
-            return row["lastUpdate"]
-        else:
-            return row["Deadline"]
-
 
 class CreateNestedSessionTimeSeries(BaseEstimator, TransformerMixin):
     """
-    This pipeline step will create a time series for each session TODAY. Two new columns will be created, 
-    `time_vals` and `power_vals`, respective lists for time and power demand. `time_vals` are rounded to the 
-    closest 5 min. The dataframe is optionally saved to a `data/` file.
+    This pipeline step will create a time series for each session TODAY, in long format: one row per session 
+    and 5 min, with new columns `Time` and `Power (W)`. `Time` is rounded to the closest 5 min, and only runs 
+    from midnight up to now. The dataframe is optionally saved to a `data/` file.
     """
 
     def __init__(self, save=False) -> None:
@@ -103,42 +56,27 @@ class CreateNestedSessionTimeSeries(BaseEstimator, TransformerMixin):
         return self
 
     def transform(self, X) -> pd.DataFrame:
-        self.ts_df = pd.DataFrame(columns=["time_vals", "power_vals"])
-
-        X.apply(self.__create_ts, axis=1)
+        step = np.timedelta64(5, "m")
 
-        X = pd.concat([X.reset_index(), self.ts_df], axis=1)
+        # for scheduled charging, values are simulated; return up to current time to feel like dashboard is in "real time"
+        today = pd.to_datetime(datetime.now(pytz.timezone('US/Pacific')).strftime("%D")).to_datetime64()
+        now = datetime.now(pytz.timezone('US/Pacific')).strftime('%Y-%m-%d %H:%M:%S')
+        now = pd.to_datetime(now).floor("5T").to_datetime64()
 
-        X = X.explode(["time_vals", "power_vals"])
-        X.rename(columns={"time_vals": "Time", "power_vals": "Power (W)"}, inplace=True)
+        # clip each session to today's window before expanding, all bounds are on the 5 min grid
+        start = np.maximum(X["startChargeTime"].dt.round("5min").to_numpy(), today)
+        end = np.minimum(X["finishChargeTime"].dt.round("5min").to_numpy(), now)
 
-        X = X[(X["Time"] >= datetime.now(pytz.timezone('US/Pacific')).strftime("%D"))].copy()  # keep sessions within today
+        # number of 5 min values per session; sessions outside the window (or missing times) have none
+        counts = np.where(end >= start, (end - start) // step + 1, 0)
+        session = np.repeat(np.arange(len(X)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
 
-        # for scheduled charging, values are simulated; return up to current time to feel like dashboard is in "real time"
-        now = datetime.now(pytz.timezone('US/Pacific')).strftime('%Y-%m-%d %H:%M:%S')
-        now = pd.to_datetime(now).floor("5T").strftime('%Y-%m-%d %H:%M:%S')
-        X = X[X["Time"] <= now].copy()
+        X = X.reset_index().iloc[session].copy()
+        X["Time"] = start[session] + offsets * step
+        X["Power (W)"] = X["true_peakPower_W"].to_numpy()
 
         if self.save:
             X.to_csv("data/todays_sessions.csv")
 
         return X
-
-    def __create_ts(self, session: pd.Series) -> pd.DataFrame:
-        """
-        This helper function takes a row, and using the `startChargeTime` and `finishChargeTime` columns, fills in a time series
-        at five minute granularity.
-        """
-
-        date_range = pd.date_range(start=session["startChargeTime"].round("5min"), end=session["finishChargeTime"].round("5min"), freq="5min").to_list()
-        power_vals = np.ones(len(date_range)) * session["true_peakPower_W"]
-
-        temp_df = pd.DataFrame({"power": power_vals}, index=date_range)
-
-        date_range = temp_df.index.to_list()
-        power_vals = temp_df["power"].to_list()
-
-        temp_df = pd.DataFrame([[date_range, power_vals]], columns=self.ts_df.columns)
-
-        self.ts_df = pd.concat([self.ts_df, temp_df], ignore_index=True)
-
@@ -0,0 +1,38 @@
+import timeit
+import pandas as pd
+from dotenv import load_dotenv
+from db.utils import db
+
+
+# frames compared by default; the largest frame, the most read frame, and the smallest frame
+KEYS = ["fivemindemand", "raw_data", "todays_sessions"]
+
+
+def benchmark_codecs(frames: dict, codecs: tuple = db.codecs, repeat: int = 5) -> pd.DataFrame:
+    """
+    This function serializes every dataframe in `frames` with every codec in `codecs`, and returns
+    the best encode and decode times (in milliseconds) of `repeat` runs, and the payload size (in kB).
+    """
+    results = []
+    for name, df in frames.items():
+        for codec in codecs:
+            buffer = db.encode_df(df, codec)
+            encode_time = min(timeit.repeat(lambda: db.encode_df(df, codec), number=1, repeat=repeat))
+            decode_time = min(timeit.repeat(lambda: db.decode_df(buffer), number=1, repeat=repeat))
+            results.append({
+                "name": name,
+                "codec": codec,
+                "encode_ms": round(encode_time * 1000, 2),
+                "decode_ms": round(decode_time * 1000, 2),
+                "size_kB": round(len(buffer) / 1000, 1),
+            })
+
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    # run from `src/` as `python -m db.benchmark_codecs`, with `REDIS_URI` pointing at a populated Redis
+    load_dotenv()
+    r = db.get_redis_connection()
+    frames = dict(zip(KEYS, db.get_multiple_df(r, KEYS)))
+    print(benchmark_codecs(frames).to_string(index=False))
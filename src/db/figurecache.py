@@ -0,0 +1,105 @@
+import redis
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from db.utils import db
+
+
+class FigureCache:
+
+    # figures are stored as serialized JSON under `figure:{version}:{function}:{digest of the arguments}`, so a new
+    # snapshot invalidates every figure drawn from the previous one; at most `max_figures` are kept in-process,
+    # least recently used first out
+    max_figures = 256
+    __figures = OrderedDict()
+    __version = None # snapshot version the in-process figures were drawn from
+    __lock = threading.Lock()
+
+    # figures can also be shared through Redis, between workers and instances, expiring with the snapshot's keys
+    use_redis = False
+    redis_ttl = db.snapshot_ttl
+
+    @staticmethod
+    def get_key(version: int, function: str, args: tuple) -> str:
+        """
+        This function returns the cache key of a figure drawn by `function` from `args`, with snapshot `version`.
+        """
+        digest = hashlib.sha1(json.dumps(args, default=str).encode()).hexdigest()
+        return f"figure:{version}:{function}:{digest}"
+
+
+    @classmethod
+    def get(cls, redis_client: redis.Redis, version: int, key: str) -> str:
+        """
+        This function returns the serialized figure stored at `key`, or None if it hasn't been drawn
+        from snapshot `version` yet. Figures of older snapshots are dropped.
+        """
+        with cls.__lock:
+            if cls.__version != version:
+                cls.__figures.clear()
+                cls.__version = version
+            if key in cls.__figures:
+                cls.__figures.move_to_end(key)
+                return cls.__figures[key]
+
+        if not cls.use_redis:
+            return None
+
+        figure = redis_client.get(key)
+        if figure is not None:
+            figure = figure.decode()
+            cls.__set_local(version, key, figure)
+        return figure
+
+
+    @classmethod
+    def set(cls, redis_client: redis.Redis, version: int, key: str, figure: str) -> None:
+        """
+        This function stores a serialized figure drawn from snapshot `version` at `key`.
+        """
+        cls.__set_local(version, key, figure)
+        if cls.use_redis:
+            redis_client.set(key, figure, ex=cls.redis_ttl)
+
+
+    @classmethod
+    def __set_local(cls, version: int, key: str, figure: str) -> None:
+        """
+        This function stores a serialized figure in-process, evicting the least recently used figures past `max_figures`.
+        Figures drawn from a snapshot that's already been superseded aren't kept.
+        """
+        with cls.__lock:
+            if cls.__version != version:
+                return
+            cls.__figures[key] = figure
+            cls.__figures.move_to_end(key)
+            while len(cls.__figures) > cls.max_figures:
+                cls.__figures.popitem(last=False)
+
+
+    @classmethod
+    def cached(cls, redis_client: redis.Redis):
+        """
+        This function decorates a function drawing a Plotly figure from the current snapshot, so it's only drawn once
+        per snapshot and arguments. The arguments must be JSON serializable, and fully decide the figure.
+        A cached figure is returned as a dictionary, which Dash sends as is.
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args):
+                version = db.get_latest_version(redis_client)
+                if version is None:
+                    return function(*args)
+
+                key = cls.get_key(version, function.__qualname__, args)
+                figure = cls.get(redis_client, version, key)
+                if figure is not None:
+                    return json.loads(figure)
+
+                fig = function(*args)
+                cls.set(redis_client, version, key, fig.to_json())
+                return fig
+            return wrapper
+        return decorator
@@ -1,7 +1,11 @@
 import redis 
 import os
+import json
+import hashlib
 import pickle
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from redis.backoff import ExponentialBackoff
 from redis.retry import Retry
 from redis.exceptions import BusyLoadingError, ConnectionError, TimeoutError
@@ -10,6 +14,54 @@ from io import BytesIO
 
 class db:
 
+    # codecs a dataframe can be stored with; `parquet` is compact, Arrow IPC is much cheaper to decode
+    codecs = ("parquet", "ipc", "ipc_lz4", "ipc_zstd")
+    default_codec = "parquet"
+
+    # codec per key, for the frames read on (nearly) every dashboard callback; any other key uses `default_codec`
+    key_codecs = {
+        "fivemindemand": "ipc_lz4",
+        "hourlydemand": "ipc_lz4",
+        "dailydemand": "ipc_lz4",
+        "monthlydemand": "ipc_lz4",
+        "hoverdistributions": "ipc_lz4",
+        "todays_sessions": "ipc_lz4",
+        "raw_data_subset": "ipc_lz4",
+    }
+
+    # time column (or index) of the frames that can be read by time range; these frames are stored in
+    # row groups (Parquet) or record batches (Arrow IPC) of `row_group_rows` rows, with their time bounds
+    time_columns = {
+        "fivemindemand": "time",
+        "hourlydemand": "time",
+        "dailydemand": "time",
+        "monthlydemand": "time",
+        "raw_data": "connectTime",
+        "raw_data_subset": "connectTime",
+    }
+    row_group_rows = 8192
+
+    # large frames, stored as one key per month of their time column, so writers only rewrite the months 
+    # that changed, and readers only fetch the months overlapping their time range
+    chunked_keys = ("fivemindemand", "raw_data")
+
+    # dataframes are published as snapshots: every frame (or monthly chunk) is stored under a content-addressed key,
+    # `{name}:{digest}` (or `{name}:{yyyy-mm}:{digest}`), listed by the snapshot's manifest `snapshot:{version}`; 
+    # `version_key` points at the current snapshot, and superseded keys expire after `snapshot_ttl` seconds
+    version_key = "version"
+    snapshot_ttl = 3600
+
+    # channel every new snapshot's version is published on; see `listen_for_snapshots`
+    snapshot_channel = "snapshots"
+    __listener = None # background subscriber thread
+    __latest_version = None # latest version heard by the subscriber
+
+    # process-local cache as {key: value}, where the value is the stored buffer or, once it has been read in full, 
+    # the decoded dataframe; keys are content-addressed, so only keys of the current snapshot are kept
+    use_cache = True
+    __cache = {}
+    __snapshot = (None, None) # (version, manifest) of the current snapshot
+
     @staticmethod
     def get_redis_connection() -> redis.Redis:
         '''
@@ -40,35 +92,422 @@ class db:
 
     
     @classmethod
-    def get_df(cls, redis_client: redis.Redis, name) -> pd.DataFrame:
+    def encode_df(cls, df: pd.DataFrame, codec: str = None, time_column: str = None) -> bytes:
+        """
+        This function serializes a dataframe with one of `codecs`, `default_codec` by default. 
+        The index is kept with every codec. Data is written in chunks of `row_group_rows` rows;
+        if `time_column` is given, Arrow IPC also records the time bounds of each chunk (Parquet always keeps statistics).
+        """
+        codec = cls.default_codec if codec is None else codec
+
+        if codec == "parquet":
+            return df.to_parquet(row_group_size=cls.row_group_rows)
+        elif codec in ("ipc", "ipc_lz4", "ipc_zstd"):
+            table = pa.Table.from_pandas(df)
+            batches = table.to_batches(max_chunksize=cls.row_group_rows)
+
+            schema = table.schema
+            if time_column is not None:
+                times = [batch.column(time_column).to_pandas() for batch in batches]
+                bounds = [[None if pd.isna(bound) else bound.value for bound in (batch_times.min(), batch_times.max())] for batch_times in times]
+                schema = schema.with_metadata({**schema.metadata, b"time_column": time_column, b"batch_bounds": json.dumps(bounds)})
+
+            options = pa.ipc.IpcWriteOptions(compression=codec.removeprefix("ipc_") if codec != "ipc" else None)
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_file(sink, schema, options=options) as writer:
+                for batch in batches:
+                    writer.write_batch(batch)
+            return sink.getvalue().to_pybytes()
+
+        raise ValueError(f"Unknown codec '{codec}', expected one of {cls.codecs}.")
+
+
+    @staticmethod
+    def query_df(df: pd.DataFrame, columns: list = None, time_range: tuple = None, time_column: str = None) -> pd.DataFrame:
+        """
+        This function keeps only `columns` of a dataframe (and its index), and the rows with a `time_column` value
+        (or index value, if the index is named `time_column`) between the bounds of `time_range`.
+        ~~~
+        Parameters:
+        df : Dataframe to be queried.
+        columns : Columns to keep, all by default.
+        time_range : Inclusive (start, end) bounds, in any format pandas can compare; a None bound is ignored.
+        time_column : Column or index to query time on.
+        """
+        if time_range is not None:
+            start, end = time_range
+            times = df.index if df.index.name == time_column else df[time_column]
+            mask = np.ones(len(df), dtype=bool)
+            if start is not None:
+                mask &= np.asarray(times >= start)
+            if end is not None:
+                mask &= np.asarray(times <= end)
+            df = df.loc[mask]
+        if columns is not None:
+            df = df[columns]
+        return df
+
+
+    @classmethod
+    def decode_df(cls, buffer: bytes, columns: list = None, time_range: tuple = None, time_column: str = None) -> pd.DataFrame:
+        """
+        This function deserializes a dataframe serialized by `encode_df`. The codec is detected from the 
+        leading magic bytes, so keys can switch codecs without breaking readers of existing values.
+        With `columns` and/or `time_range` (see `query_df`), only those columns and the chunks overlapping the range are decoded.
+        """
+        if time_range is not None:
+            time_range = tuple(None if bound is None else pd.to_datetime(bound) for bound in time_range)
+
+        if buffer[:6] == b"ARROW1":
+            # Arrow IPC reads straight out of the buffer, compression is handled per record batch
+            reader = pa.ipc.open_file(pa.py_buffer(buffer))
+            metadata = reader.schema.metadata or {}
+
+            batches = range(reader.num_record_batches)
+            if time_range is not None and metadata.get(b"time_column", b"").decode() == time_column:
+                start, end = time_range
+                bounds = json.loads(metadata[b"batch_bounds"])
+                # bounds are in nanoseconds; batches without any times can't have rows in range
+                batches = [
+                    idx for idx, (batch_start, batch_end) in zip(batches, bounds)
+                    if batch_start is not None 
+                    and (end is None or batch_start <= end.value) and (start is None or batch_end >= start.value)
+                ]
+
+            table = pa.Table.from_batches([reader.get_batch(idx) for idx in batches], schema=reader.schema)
+            if columns is not None:
+                index_columns = [column for column in reader.schema.pandas_metadata["index_columns"] if isinstance(column, str)]
+                extra_columns = [time_column] if time_range is not None and time_column not in index_columns + columns else []
+                table = table.select(index_columns + columns + extra_columns)
+            df = table.to_pandas()
+
+        elif columns is None and time_range is None:
+            df = pd.read_parquet(BytesIO(buffer))
+
+        else:
+            # row groups outside of the range are skipped using their statistics
+            filters = None
+            if time_range is not None:
+                start, end = time_range
+                filters = [(time_column, ">=", start)] if start is not None else []
+                filters += [(time_column, "<=", end)] if end is not None else []
+            extra_columns = [time_column] if columns is not None and time_range is not None and time_column not in columns else []
+            df = pd.read_parquet(BytesIO(buffer), columns=None if columns is None else columns + extra_columns, filters=filters or None)
+
+        return cls.query_df(df, columns, time_range, time_column)
+
+
+    @classmethod
+    def get_version(cls, redis_client: redis.Redis) -> int:
+        """
+        This function returns the current snapshot version, or None if nothing has been published yet.
+        """
+        version = redis_client.get(cls.version_key)
+        return None if version is None else int(version)
+
+
+    @classmethod
+    def listen_for_snapshots(cls, redis_client: redis.Redis) -> None:
+        """
+        This function subscribes to `snapshot_channel` in a background thread, keeping track of the latest 
+        published version, so `get_latest_version` (and readers) don't have to ask Redis. If the subscription 
+        fails, the thread stops and versions are read from Redis again. Does nothing if already listening.
+        """
+        if cls.__listener is not None and cls.__listener.is_alive():
+            return
+
+        def on_snapshot(message):
+            cls.__latest_version = max(int(message["data"]), cls.__latest_version or 0)
+
+        def on_error(error, pubsub, thread):
+            thread.stop()
+
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{cls.snapshot_channel: on_snapshot})
+        # snapshots published before subscribing aren't heard
+        cls.__latest_version = cls.get_version(redis_client)
+        cls.__listener = pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=on_error)
+
+
+    @classmethod
+    def get_latest_version(cls, redis_client: redis.Redis) -> int:
+        """
+        This function returns the current snapshot version, as heard by `listen_for_snapshots` if it's listening, 
+        and otherwise read from Redis.
+        """
+        if cls.__listener is not None and cls.__listener.is_alive() and cls.__latest_version is not None:
+            return cls.__latest_version
+        return cls.get_version(redis_client)
+
+
+    @staticmethod
+    def __get_snapshot_keys(snapshot: dict) -> set:
+        """
+        This function returns every key a snapshot manifest points at.
+        """
+        keys = set()
+        for entry in snapshot.values():
+            keys.update(entry["chunks"].values() if "chunks" in entry else [entry["key"]])
+        return keys
+
+
+    @classmethod
+    def __get_snapshot(cls, redis_client: redis.Redis) -> dict:
+        """
+        This function returns the manifest of the current snapshot as {name: entry}, or None if there is none 
+        (frames are then read from their plain, pre-snapshot keys). A new snapshot's manifest is fetched once, 
+        and cached values it no longer points at are dropped.
+        """
+        version = cls.get_latest_version(redis_client)
+        if version is None:
+            return None
+        if cls.__snapshot[0] == version:
+            return cls.__snapshot[1]
+
+        snapshot = redis_client.get(f"snapshot:{version}")
+        if snapshot is None:
+            return None
+        snapshot = json.loads(snapshot)
+
+        keys = cls.__get_snapshot_keys(snapshot)
+        cls.__cache = {key: value for key, value in cls.__cache.items() if key in keys}
+        cls.__snapshot = (version, snapshot)
+        return snapshot
+
+
+    @classmethod
+    def __get_cached(cls, key: str):
+        """
+        This function returns the cached buffer or dataframe stored at `key`, if any.
+        """
+        return cls.__cache.get(key) if cls.use_cache else None
+
+
+    @classmethod
+    def __set_cached(cls, key: str, value) -> None:
+        """
+        This function caches a freshly fetched buffer, or decoded dataframe, of a key in the current snapshot.
+        """
+        snapshot = cls.__snapshot[1]
+        if cls.use_cache and snapshot is not None and key in cls.__get_snapshot_keys(snapshot):
+            cls.__cache[key] = value
+
+
+    @classmethod
+    def __fetch(cls, redis_client: redis.Redis, keys: list) -> dict:
+        """
+        This function returns the values of `keys`, from the cache when possible, and otherwise fetched 
+        (and cached) in a single pipeline.
+        """
+        values = {key: cls.__get_cached(key) for key in keys}
+        missing = [key for key, value in values.items() if value is None]
+
+        if missing:
+            pipe = redis_client.pipeline()
+
+            for key in missing:
+                pipe.get(key)
+
+            for key, buffer in zip(missing, pipe.execute()):
+                cls.__set_cached(key, buffer)
+                values[key] = buffer
+
+        return values
+
+
+    @classmethod
+    def __read_cached(cls, key: str, value, columns: list = None, time_range: tuple = None, time_column: str = None) -> pd.DataFrame:
+        """
+        This function returns the dataframe stored at `key` (or the part of it selected by `columns` and `time_range`) 
+        from a cached or just fetched value. Whole dataframes decoded from a buffer are cached in its place. 
+        Copies are returned, since callers are free to modify the dataframes they get.
+        """
+        if isinstance(value, pd.DataFrame):
+            return cls.query_df(value, columns, time_range, time_column).copy(deep=True)
+
+        if columns is not None or time_range is not None:
+            return cls.decode_df(value, columns, time_range, time_column)
+
+        df = cls.decode_df(value)
+        cls.__set_cached(key, df)
+        return df.copy(deep=True) if cls.__get_cached(key) is df else df
+
+
+    @staticmethod
+    def __split_months(df: pd.DataFrame, time_column: str) -> dict:
+        """
+        This function splits a dataframe into chunks by the month ('yyyy-mm') of `time_column`, in order of month. 
+        Rows without a time go to the `undated` chunk, and an empty dataframe is kept as a single `empty` chunk.
+        """
+        if df.empty:
+            return {"empty": df}
+
+        times = pd.Series(df.index if df.index.name == time_column else df[time_column])
+        months = times.dt.strftime("%Y-%m").fillna("undated").to_numpy()
+        return {month: chunk for month, chunk in df.groupby(months, sort=True)}
+
+
+    @staticmethod
+    def __get_digest(df: pd.DataFrame) -> str:
+        """
+        This function returns a digest of a dataframe's values, index, columns and dtypes.
+        """
+        digest = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+        digest.update(str(list(zip(df.columns, df.dtypes))).encode())
+        return digest.hexdigest()
+
+
+    @classmethod
+    def __get_entry_keys(cls, name: str, entry: dict, time_range: tuple = None) -> list:
+        """
+        This function returns the keys to read for a snapshot entry. For chunked frames, only the months 
+        overlapping `time_range` are read; undated rows only belong to unbounded reads.
+        """
+        if "chunks" not in entry:
+            return [entry["key"]]
+
+        months = list(entry["chunks"])
+        if time_range is not None and tuple(time_range) != (None, None):
+            start, end = [None if bound is None else pd.to_datetime(bound).strftime("%Y-%m") for bound in time_range]
+            months = [
+                month for month in months 
+                if month not in ("undated", "empty") and (start is None or month >= start) and (end is None or month <= end)
+            ]
+        # with no months in range, one chunk is still read for the columns of the (empty) result
+        months = months or list(entry["chunks"])[:1]
+        return [entry["chunks"][month] for month in months]
+
+
+    @classmethod
+    def __read_entry(cls, name: str, keys: list, values: dict, columns: list = None, time_range: tuple = None) -> pd.DataFrame:
+        """
+        This function reads a dataframe out of the fetched values of its keys, concatenating chunks in order.
+        """
+        time_column = cls.time_columns.get(name)
+        chunks = [cls.__read_cached(key, values[key], columns, time_range, time_column) for key in keys]
+        return pd.concat(chunks) if len(chunks) > 1 else chunks[0]
+
+
+    @classmethod
+    def __encode_entry(cls, name: str, df: pd.DataFrame, codec: str, previous: dict, blobs: dict) -> dict:
+        """
+        This function returns the snapshot entry of a dataframe, adding the buffers of keys the previous entry 
+        doesn't already point at to `blobs`. Chunks are digested before encoding, so unchanged months are never re-encoded.
+        """
+        previous = {} if previous is None else previous
+
+        if name in cls.chunked_keys:
+            time_column = cls.time_columns[name]
+            previous_chunks = previous.get("chunks", {})
+            chunks = {}
+            for month, chunk in cls.__split_months(df, time_column).items():
+                chunks[month] = f"{name}:{month}:{cls.__get_digest(chunk)}"
+                if chunks[month] != previous_chunks.get(month):
+                    blobs[chunks[month]] = cls.encode_df(chunk, codec, time_column)
+            return {"chunks": chunks}
+
+        buffer = cls.encode_df(df, codec, cls.time_columns.get(name))
+        key = f"{name}:{hashlib.sha1(buffer).hexdigest()}"
+        if key != previous.get("key"):
+            blobs[key] = buffer
+        return {"key": key}
+
+
+    @classmethod
+    def publish_snapshot(cls, redis_client: redis.Redis, frames: dict, codecs: dict = None, replace_prefixes: tuple = ()) -> int:
+        """
+        This function publishes dataframes, {name: dataframe}, as a new snapshot, and returns its version. 
+        Frames not in `frames` are carried over from the current snapshot, so tasks can publish only what they computed.
+        Everything is written in one transaction that also flips `version_key` (and announces the new version on 
+        `snapshot_channel`), so readers see either the whole snapshot or none of it; the transaction is retried if another publish lands first. Keys only the previous 
+        snapshot used (and frames' plain, pre-snapshot keys) expire after `snapshot_ttl` seconds.
+        ~~~
+        Parameters:
+        frames : Dataframes to publish, by name.
+        codecs : Codec per name, overriding `key_codecs`.
+        replace_prefixes : Prefixes of names published as a group (e.g. `chargers_` for the per-site frames); names 
+            with these prefixes that aren't in `frames` are dropped instead of carried over.
+        """
+        codecs = {} if codecs is None else codecs
+
+        with redis_client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(cls.version_key)
+                    version = pipe.get(cls.version_key)
+                    version = 0 if version is None else int(version)
+                    previous = pipe.get(f"snapshot:{version}")
+                    previous = json.loads(previous) if previous is not None else {}
+
+                    snapshot = {
+                        name: entry for name, entry in previous.items() 
+                        if name in frames or not name.startswith(tuple(replace_prefixes))
+                    }
+                    blobs = {}
+                    for name, df in frames.items():
+                        codec = codecs.get(name, cls.key_codecs.get(name, cls.default_codec))
+                        snapshot[name] = cls.__encode_entry(name, df, codec, previous.get(name), blobs)
+
+                    pipe.multi()
+                    for key, buffer in blobs.items():
+                        pipe.set(key, buffer)
+                    for key in (cls.__get_snapshot_keys(previous) - cls.__get_snapshot_keys(snapshot)) | set(frames):
+                        pipe.expire(key, cls.snapshot_ttl)
+                    pipe.set(f"snapshot:{version + 1}", json.dumps(snapshot))
+                    pipe.expire(f"snapshot:{version}", cls.snapshot_ttl)
+                    pipe.set(cls.version_key, version + 1)
+                    pipe.publish(cls.snapshot_channel, version + 1)
+                    pipe.execute()
+
+                    return version + 1
+                except redis.WatchError:
+                    continue
+
+
+    @classmethod
+    def exists(cls, redis_client: redis.Redis, names: list) -> bool:
+        """
+        This function returns whether every dataframe in `names` has been published.
+        """
+        snapshot = cls.__get_snapshot(redis_client)
+        if snapshot is not None:
+            return all(name in snapshot for name in names)
+        return redis_client.exists(*names) == len(names)
+
+
+    @classmethod
+    def get_df(cls, redis_client: redis.Redis, name, columns: list = None, time_range: tuple = None) -> pd.DataFrame:
         """
         All dataframes except should be retrieved with this method. 
+        The dataframe is read from the current snapshot, and only fetched if it isn't cached. With `columns` and/or `time_range`
+        (inclusive (start, end) bounds on the frame's `time_columns` entry), only that part of the dataframe is decoded.
         """
-        buffer = redis_client.get(name)
-        result = pd.read_parquet(BytesIO(buffer))
+        result = cls.get_multiple_df(redis_client, [name], columns, time_range)[0]
         return result
     
     
     @classmethod
-    def send_df(cls, redis_client: redis.Redis, df: pd.DataFrame, name: str) -> None:
+    def send_df(cls, redis_client: redis.Redis, df: pd.DataFrame, name: str, codec: str = None) -> None:
         """
-        All dataframes should be sent with this method.  
+        All dataframes should be sent with this method. The dataframe is serialized with `codec`, 
+        or the codec configured for `name` in `key_codecs`, and published on its own (see `publish_snapshot`).
         """
-        pq = df.to_parquet()
-        redis_client.set(name, pq)
+        cls.publish_snapshot(redis_client, {name: df}, None if codec is None else {name: codec})
 
 
     @classmethod
-    def get_multiple_df(cls, redis_client: redis.Redis, names: list) -> list[pd.DataFrame]:
+    def get_multiple_df(cls, redis_client: redis.Redis, names: list, columns: list = None, time_range: tuple = None) -> list[pd.DataFrame]:
         """
         For retrieving multiple dataframes in a block. Returns as a list in the same order as input.
+        All of them come from the same snapshot, and only the keys that aren't cached are fetched, in one pipeline.
         """
-        pipe = redis_client.pipeline()
+        snapshot = cls.__get_snapshot(redis_client)
 
-        for name in names:
-            pipe.get(name)
+        # frames not published in a snapshot yet are read from their plain keys
+        keys = {
+            name: cls.__get_entry_keys(name, snapshot[name], time_range) if snapshot is not None and name in snapshot else [name] 
+            for name in names
+        }
+        values = cls.__fetch(redis_client, [key for name in names for key in keys[name]])
 
-        res = pipe.execute()
-        res = [pd.read_parquet(BytesIO(buffer)) for buffer in res] 
-        return res
-    
\ No newline at end of file
+        return [cls.__read_entry(name, keys[name], values, columns, time_range) for name in names]
@@ -6,13 +6,17 @@ from dash_bootstrap_templates import ThemeChangerAIO
 from plotting import plottingfunctions as pltf
 from datetime import timedelta, datetime
 from dash import html, dcc
-from dash.dependencies import Output, Input, State
+from dash.dependencies import Output, Input, State, ClientsideFunction
 from db.utils import db
+from db.figurecache import FigureCache
 
 dash.register_page(__name__, path="/alltime")
 
 r = db.get_redis_connection()
 
+# draw the hover histograms in the browser, from distributions sent once per refresh, instead of on the server per hover
+CLIENTSIDE_HISTOGRAMS = True
+
 ### --> Helper Functions <-- ###
 
 def get_last_days_datetime(n):
@@ -30,6 +34,37 @@ def prediction_to_run(granularity):
         return db.get_df(r, "dailyforecasts")
     elif granularity == "monthlydemand":
         return  # not yet supported
+
+
+def get_uirevision(granularity, quantity, start_date, end_date):
+    '''
+    Returns the main time series' `uirevision`; the user's zoom is kept until the series or dates picked change.
+    '''
+    return f"{granularity}-{quantity}-{start_date}-{end_date}"
+
+
+def get_zoomed_range(relayout_data):
+    '''
+    Returns the x-axis range of a zoom or pan on the main time series, `(None, None)` if the axes were reset, 
+    or `None` if the relayout didn't move the x-axis (e.g. a resize).
+    '''
+    if not relayout_data:
+        return None
+    if "xaxis.range[0]" in relayout_data:
+        return relayout_data["xaxis.range[0]"], relayout_data["xaxis.range[1]"]
+    if "xaxis.range" in relayout_data:
+        return tuple(relayout_data["xaxis.range"])
+    if relayout_data.get("xaxis.autorange"):
+        return None, None
+    return None
+
+
+# columns of `raw_data` each cumulative graph uses
+cumulative_graph_columns = {
+    "cumulative-energy-delivered": ["finishChargeTime", "cumEnergy_Wh"],
+    "cumulative-num-users": ["startChargeTime", "userId"],
+    "cumulative-vehicle-model-energy": ["startChargeTime", "vehicle_model", "cumEnergy_Wh"],
+}
     
 ### --> <-- ###
 
@@ -131,6 +166,7 @@ tab_one_content = \
                                 dbc.Col([
                                     html.Div([
                                         dcc.Loading([
+                                            dcc.Store(id="time-series-zoom"),
                                             dcc.Graph(
                                                 id="time-series-plot",
                                                 style={"height": "70vh"},
@@ -161,7 +197,9 @@ tab_one_content = \
                                                     "displaylogo": False
                                                 },
                                                 className="p-1"
-                                            )
+                                            ),
+                                            dcc.Store(id="hover-distributions"),
+                                            dcc.Store(id="hover-histogram-template"),
                                         ], type="circle")
                                     ], className="d-flex flex-column border rounded shadow")
                                 ], className="col-xl-3 col-12 px-2", id="hover-histogram-col")
@@ -346,20 +384,49 @@ layout = \
 # update main time series callback
 @dash.callback(
     Output("time-series-plot", "figure"),
+    Output("time-series-zoom", "data"),
     Input("dataframe-picker", "value"),
     Input("quantity-picker", "value"),
     Input("maints-date-picker", "start_date"),
     Input("maints-date-picker", "end_date"),
     Input("toggle-forecasts", "checked"),
+    Input("time-series-plot", "relayoutData"),
     Input("data-refresh-signal", "data"),
-    Input(ThemeChangerAIO.ids.radio("theme"), "value")
+    State("time-series-zoom", "data"),
+    State(ThemeChangerAIO.ids.radio("theme"), "value")
 )
-def display_main_figure(granularity, quantity, start_date, end_date, forecasts, data_signal, theme):
-    # load data
-    data = db.get_df(r, granularity)
+def display_main_figure(granularity, quantity, start_date, end_date, forecasts, relayout_data, data_signal, zoom, theme):
+    # the series is downsampled, so only the zoomed window (within the dates picked) is re-sampled; the zoom is kept 
+    # for as long as the `uirevision` is, so refreshes and the forecasts toggle re-sample the window still in view
+    uirevision = get_uirevision(granularity, quantity, start_date, end_date)
+    zoomed_range = zoom["range"] if zoom is not None and zoom["uirevision"] == uirevision else (None, None)
+    if dash.ctx.triggered_id == "time-series-plot":
+        zoomed_range = get_zoomed_range(relayout_data)
+        if zoomed_range is None:
+            return dash.no_update, dash.no_update
+
+    plot_start, plot_end = start_date, end_date
+    zoom_start, zoom_end = zoomed_range
+    if zoom_start is not None and (start_date is None or pd.to_datetime(zoom_start) > pd.to_datetime(start_date)):
+        plot_start = zoom_start
+    if zoom_end is not None and (end_date is None or pd.to_datetime(zoom_end) < pd.to_datetime(end_date)):
+        plot_end = zoom_end
+
+    fig = draw_main_figure(granularity, quantity, start_date, end_date, plot_start, plot_end, forecasts, theme)
+    return fig, {"uirevision": uirevision, "range": list(zoomed_range)}
+
+
+@FigureCache.cached(r)
+def draw_main_figure(granularity, quantity, start_date, end_date, plot_start, plot_end, forecasts, theme):
+    # load data, only the quantity (and hover data) shown and the dates plotted
+    columns = [quantity] + pltf.PlotMainTimeSeries.other_columns[granularity]["hoverdata"]
+    data = db.get_df(r, granularity, columns=columns, time_range=(plot_start, plot_end))
 
     # plot main time series
-    fig = pltf.PlotMainTimeSeries.plot_main_time_series(data, granularity, quantity, start_date, end_date, theme)
+    fig = pltf.PlotMainTimeSeries.plot_main_time_series(data, granularity, quantity, plot_start, plot_end, theme)
+
+    # keep the user's zoom across re-samples, until the series or dates picked change
+    fig.update_layout(uirevision=get_uirevision(granularity, quantity, start_date, end_date))
 
     # plot predictions (if supported)
     if forecasts and granularity != "fivemindemand" and granularity != "monthlydemand":
@@ -370,35 +437,68 @@ def display_main_figure(granularity, quantity, start_date, end_date, forecasts,
 
 
 # update histograms callback
-@dash.callback(
-    Output("day-histogram", "figure"),
-    Output("hour-histogram", "figure"),
-    Input("time-series-plot", "hoverData"),
-    State("quantity-picker", "value"),
-    State("dataframe-picker", "value"),
-    Input(ThemeChangerAIO.ids.radio("theme"), "value"),
-)
-def display_histogram_hover(hoverData, quantity, granularity, theme):
-
-    # place holder for no hover
-    if hoverData is None:
-        return pltf.PlotHoverHistogram.default(theme), pltf.PlotHoverHistogram.default(theme)
-
-    # load data
-    hourlydemand, dailydemand = db.get_multiple_df(r, ["hourlydemand", "dailydemand"])
-
-    # create hover histograms
-    if granularity == "dailydemand":
-        day_hist = pltf.PlotHoverHistogram.plot_day_hover_histogram(hoverData, dailydemand, quantity, granularity, theme)
-        return day_hist, pltf.PlotHoverHistogram.empty_histogram_figure(theme)
-
-    elif granularity == "monthlydemand":
-        return pltf.PlotHoverHistogram.empty_histogram_figure(theme), pltf.PlotHoverHistogram.empty_histogram_figure(theme)
+if CLIENTSIDE_HISTOGRAMS:
+    # send the distributions once per refresh
+    @dash.callback(
+        Output("hover-distributions", "data"),
+        Input("data-refresh-signal", "data"),
+    )
+    def load_hover_distributions(data_signal):
+        distributions = db.get_df(r, "hoverdistributions")
+        dailydemand = db.get_df(r, "dailydemand", columns=list(pltf.PlotHoverHistogram.cleaned_column_names))
+        return pltf.PlotHoverHistogram.get_client_distributions(distributions, dailydemand)
+
+    # the browser can't build theme templates, so the theme's template JSON is sent on theme change
+    @dash.callback(
+        Output("hover-histogram-template", "data"),
+        Input(ThemeChangerAIO.ids.radio("theme"), "value"),
+    )
+    def load_hover_histogram_template(theme):
+        return pltf.get_theme_template(theme)
+
+    dash.clientside_callback(
+        ClientsideFunction(namespace="hover_histograms", function_name="render"),
+        Output("day-histogram", "figure"),
+        Output("hour-histogram", "figure"),
+        Input("time-series-plot", "hoverData"),
+        Input("hover-histogram-template", "data"),
+        Input("hover-distributions", "data"),
+        State("quantity-picker", "value"),
+        State("dataframe-picker", "value"),
+    )
+
+else:
+    @dash.callback(
+        Output("day-histogram", "figure"),
+        Output("hour-histogram", "figure"),
+        Input("time-series-plot", "hoverData"),
+        State("quantity-picker", "value"),
+        State("dataframe-picker", "value"),
+        State(ThemeChangerAIO.ids.radio("theme"), "value"),
+    )
+    def display_histogram_hover(hoverData, quantity, granularity, theme):
+
+        # place holder for no hover
+        if hoverData is None:
+            return pltf.PlotHoverHistogram.default(theme), pltf.PlotHoverHistogram.default(theme)
+
+        if granularity == "monthlydemand":
+            return pltf.PlotHoverHistogram.empty_histogram_figure(theme), pltf.PlotHoverHistogram.empty_histogram_figure(theme)
+
+        # load data, the precomputed distributions and the hovered day's demand
+        hovered_day = pd.to_datetime(hoverData["points"][0]["x"]).strftime("%Y-%m-%d")
+        distributions = db.get_df(r, "hoverdistributions")
+        dailydemand = db.get_df(r, "dailydemand", columns=[quantity], time_range=(hovered_day, hovered_day))
+
+        # create hover histograms
+        if granularity == "dailydemand":
+            day_hist = pltf.PlotHoverHistogram.plot_day_hover_histogram(hoverData, distributions, dailydemand, quantity, granularity, theme)
+            return day_hist, pltf.PlotHoverHistogram.empty_histogram_figure(theme)
     
-    elif granularity == "hourlydemand" or granularity == "fivemindemand":
-        day_hist = pltf.PlotHoverHistogram.plot_day_hover_histogram(hoverData, dailydemand, quantity, granularity, theme)
-        hour_hist = pltf.PlotHoverHistogram.plot_hour_hover_histogram(hoverData, hourlydemand, quantity, theme)
-        return day_hist, hour_hist
+        elif granularity == "hourlydemand" or granularity == "fivemindemand":
+            day_hist = pltf.PlotHoverHistogram.plot_day_hover_histogram(hoverData, distributions, dailydemand, quantity, granularity, theme)
+            hour_hist = pltf.PlotHoverHistogram.plot_hour_hover_histogram(hoverData, distributions, quantity, theme)
+            return day_hist, hour_hist
 
 
 # jump to present button
@@ -486,11 +586,16 @@ def toggle_tab_three_collapse(button_press, is_open):
     Input("cumulative-date-picker", "end_date"),
     Input("cumulative-graph-picker", "value"),
     Input("data-refresh-signal", "data"),
-    Input(ThemeChangerAIO.ids.radio("theme"), "value"),
+    State(ThemeChangerAIO.ids.radio("theme"), "value"),
 )
 def display_cumulative_graph(start_date, end_date, value, data_signal, theme):
+    return draw_cumulative_graph(start_date, end_date, value, theme)
+
+
+@FigureCache.cached(r)
+def draw_cumulative_graph(start_date, end_date, value, theme):
     # load data
-    data = db.get_df(r, "raw_data")
+    data = db.get_df(r, "raw_data", columns=cumulative_graph_columns[value])
     # plot figure
     if value == "cumulative-energy-delivered":
         return pltf.PlotCumulatives.plot_cumulative_energy_delivered(data, start_date, end_date, theme)
@@ -504,16 +609,45 @@ def display_cumulative_graph(start_date, end_date, value, data_signal, theme):
 @dash.callback(
     Output("sched-vs-reg-scatter", "figure"),
     Input("data-refresh-signal", "data"),
-    Input(ThemeChangerAIO.ids.radio("theme"), "value"),
+    State(ThemeChangerAIO.ids.radio("theme"), "value"),
 )
 def display_reg_vs_sched_scatter(data_signal, theme):
+    return draw_reg_vs_sched_scatter(theme)
+
+
+@FigureCache.cached(r)
+def draw_reg_vs_sched_scatter(theme):
     # load data
-    data = db.get_df(r, "raw_data")
+    data = db.get_df(r, "raw_data", columns=["sch_centsPerHr", "reg_centsPerHr", "choice"])
 
     # plot figure
     fig = pltf.PlotSchedVsReg.plot_sched_vs_reg(data, theme)
     return fig
 
+# restyle figures on theme change, without redrawing them
+@dash.callback(
+    Output("time-series-plot", "figure", allow_duplicate=True),
+    Output("cumulative-graph", "figure", allow_duplicate=True),
+    Output("sched-vs-reg-scatter", "figure", allow_duplicate=True),
+    Input(ThemeChangerAIO.ids.radio("theme"), "value"),
+    prevent_initial_call=True
+)
+def restyle_figures(theme):
+    return [pltf.restyle_figure(theme)] * 3
+
+
+# restyle server-drawn histograms on theme change (clientside ones are redrawn with the new template)
+if not CLIENTSIDE_HISTOGRAMS:
+    @dash.callback(
+        Output("day-histogram", "figure", allow_duplicate=True),
+        Output("hour-histogram", "figure", allow_duplicate=True),
+        Input(ThemeChangerAIO.ids.radio("theme"), "value"),
+        prevent_initial_call=True
+    )
+    def restyle_histograms(theme):
+        return [pltf.restyle_figure(theme)] * 2
+
+
 # hide histograms
 @dash.callback(
     Output("hover-histogram-col", "style"),
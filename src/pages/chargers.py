@@ -10,7 +10,23 @@ dash.register_page(__name__, "/chargers")
 
 r = db.get_redis_connection()
 
-charger_numbers_sorted = db.get_df(r, "chargers")["stationId"].sort_values(ascending=True).unique()
+# site shown on this page; each site's charger states are stored under their own key
+SITE_ID = 25 # UC Berkeley
+CHARGERS_KEY = f"chargers_{SITE_ID}"
+
+
+def get_site_chargers():
+    """
+    Returns the charger states of `SITE_ID`. Until they're published under `CHARGERS_KEY`, 
+    they're read from the single `chargers` key written before charger states were split per site.
+    """
+    if db.exists(r, [CHARGERS_KEY]):
+        return db.get_df(r, CHARGERS_KEY)
+    chargers = db.get_df(r, "chargers")
+    return chargers[chargers["siteId"] == SITE_ID] if "siteId" in chargers.columns else chargers
+
+
+charger_numbers_sorted = get_site_chargers()["stationId"].sort_values(ascending=True).unique()
 
 def get_charger_state(inuse: int, rate: float, vehicle_model: str, choice: str, sched_price: int, reg_price: int):
     """
@@ -35,9 +51,9 @@ def get_charger_state(inuse: int, rate: float, vehicle_model: str, choice: str,
             ]),
             html.Div([
                 html.Span([
-                    html.Div([f"Sched. Offer: {sched_price} ¢/hr"], className="px-2 py-1" + (" bg-success-subtle rounded-end rounded-pill" if choice == "SCHEDULED" else "")),
+                    html.Div([f"Sched. Offer: {sched_price:g} ¢/hr"], className="px-2 py-1" + (" bg-success-subtle rounded-end rounded-pill" if choice == "SCHEDULED" else "")),
                     html.Div(className="vr"),
-                    html.Div([f"Reg. Offer: {reg_price} ¢/hr"], className="px-2 py-1" + (" bg-success-subtle rounded-start rounded-pill" if choice == "REGULAR" else ""))
+                    html.Div([f"Reg. Offer: {reg_price:g} ¢/hr"], className="px-2 py-1" + (" bg-success-subtle rounded-start rounded-pill" if choice == "REGULAR" else ""))
                     ], className="d-inline-flex align-items-center justify-content-center my-2 fw-bolder fs-6 text-dark bg-body-secondary rounded-pill border border-info-subtle")
             ])
         ]
@@ -224,7 +240,7 @@ layout = \
 )
 def update_charger_usage(n):
     # load data
-    chargers = db.get_df(r, "chargers")
+    chargers = get_site_chargers()
 
     # calculate in use
     inuse = chargers.sort_values("stationId", ascending=True).apply(lambda row: get_charger_state(
@@ -246,7 +262,7 @@ def update_charger_usage(n):
 )
 def update_charger_utilizations(n):
     # load data
-    chargers = db.get_df(r, "chargers")
+    chargers = get_site_chargers()
 
     # calculate in use
     utilization = chargers.sort_values("stationId", ascending=True).apply(lambda row: get_charger_utilization(
@@ -274,16 +290,26 @@ for i in charger_numbers_sorted:
 @dash.callback(
     Output("charger-usage-bar-chart", "figure"),
     Input("data-refresh-signal", "data"),
-    Input(ThemeChangerAIO.ids.radio("theme"), "value"),
+    State(ThemeChangerAIO.ids.radio("theme"), "value"),
 )
 def charger_usage_bar_chart(n, theme):
     # load data
-    chargers = db.get_df(r, "chargers")
+    chargers = get_site_chargers()
 
     # plot charger usage bar chart 
     return pltf.PlotChargers.plot_charger_usage_bar_chart(chargers, theme)
 
 
+# restyle figure on theme change, without redrawing it
+@dash.callback(
+    Output("charger-usage-bar-chart", "figure", allow_duplicate=True),
+    Input(ThemeChangerAIO.ids.radio("theme"), "value"),
+    prevent_initial_call=True
+)
+def restyle_charger_usage_bar_chart(theme):
+    return pltf.restyle_figure(theme)
+
+
 # toggle settings collapse
 @dash.callback(
     Output("chargers-settings-collapse", "is_open"),
@@ -195,7 +195,10 @@ layout = \
 )
 def update_today_homepage_cards(n):
     # load data
-    today, monthlydemand, dailydemand, raw_data = db.get_multiple_df(r, ["todays_sessions", "monthlydemand", "dailydemand", "raw_data"])
+    today, monthlydemand, dailydemand = db.get_multiple_df(r, ["todays_sessions", "monthlydemand", "dailydemand"])
+    # only yesterday's users are counted
+    yesterday = pd.to_datetime(datetime.now(pytz.timezone('US/Pacific')) - timedelta(days=1)).strftime("%Y-%m-%d")
+    raw_data = db.get_df(r, "raw_data", columns=["connectTime", "userId"], time_range=(yesterday, None))
 
     # filter data to just this month
     thismonthdemand = monthlydemand.iloc[[-1]]
@@ -1,10 +1,12 @@
 import dash
 import dash_bootstrap_components as dbc
 import dash_mantine_components as dmc
+import pytz
 from dash_bootstrap_templates import ThemeChangerAIO
 from plotting import plottingfunctions as pltf
 from dash.dependencies import Input, Output, State
 from dash import html, dcc
+from datetime import datetime, timedelta
 from db.utils import db
 
 
@@ -173,20 +175,33 @@ def display_user_hover(hoverData, value, last_hovered_user):
     Input("toggle-yesterday", "checked"),
     Input("toggle-daily-forecast", "checked"),
     Input("data-refresh-signal", "data"),
-    Input(ThemeChangerAIO.ids.radio("theme"), "value"),
+    State(ThemeChangerAIO.ids.radio("theme"), "value"),
 )
 def display_today_graph(value, yesterday, forecast, data_signal, theme):
     # load data
     data = db.get_df(r, "todays_sessions")
 
     if value == "today-aggregate-power":
-        fivemindemand, daily_forecasts = db.get_multiple_df(r, ["fivemindemand", "dailyforecasts"])
+        # only yesterday's load curve is shown
+        yesterday_start = (datetime.now(pytz.timezone('US/Pacific')) - timedelta(days=1)).strftime("%Y-%m-%d")
+        fivemindemand = db.get_df(r, "fivemindemand", columns=["avg_power_demand_kW"], time_range=(yesterday_start, None))
+        daily_forecasts = db.get_df(r, "dailyforecasts")
         return pltf.PlotDaily.plot_daily_time_series(data, yesterday, fivemindemand, daily_forecasts, forecast, theme), {"display": "inline"}
 
     elif value == "today-energy-dist":
         return pltf.PlotDaily.plot_daily_energy_breakdown(data, theme), {"display": "none"}
     
 
+# restyle figure on theme change, without redrawing it
+@dash.callback(
+    Output("today-graph", "figure", allow_duplicate=True),
+    Input(ThemeChangerAIO.ids.radio("theme"), "value"),
+    prevent_initial_call=True
+)
+def restyle_today_graph(theme):
+    return pltf.restyle_figure(theme)
+
+
 # toggle settings collapse
 @dash.callback(
     Output("today-settings-collapse", "is_open"),
@@ -2,8 +2,10 @@ import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 import plotly.express as px
+import plotly.io as pio
 import pytz
 from datetime import datetime, timedelta
+from dash import Patch
 from dash_bootstrap_templates import template_from_url
 
 
@@ -30,6 +32,24 @@ def add_training_end_vline(self, start_date, end_date):
                        annotation_text="End of Training Data")
 
 
+def get_theme_template(theme) -> dict:
+    """
+    Returns the theme's figure template as JSON. `template_from_url` only returns the template's name, 
+    which plotly.py resolves when drawing, but the browser doesn't (e.g. in a patch).
+    """
+    return pio.templates[template_from_url(theme)].to_plotly_json()
+
+
+def restyle_figure(theme):
+    """
+    Returns a patch swapping an existing figure's template for the theme's, so a theme change 
+    doesn't have to redraw the figure. Colors Plotly Express already picked from the old template stay.
+    """
+    patched_figure = Patch()
+    patched_figure["layout"]["template"] = get_theme_template(theme)
+    return patched_figure
+
+
 # Class to plot main time series
 class PlotMainTimeSeries:
     other_columns = {
@@ -70,12 +90,18 @@ class PlotMainTimeSeries:
         "monthlydemand": "<extra></extra>" + "%{customdata[0]} %{x|%Y}" + "<br>%{y} %{customdata[1]}",
     }
 
+    # most points plotted; longer series are downsampled to this many points
+    max_points = 2000
+
     @classmethod
     def plot_main_time_series(cls, df: pd.DataFrame, granularity: str, quantity: str, start_date: str, end_date: str, theme=None) -> go.Figure:
 
         # filter df by date and columns
         df = cls.__query_df(df, granularity, quantity, start_date, end_date)
 
+        # bound the number of points sent to the browser
+        df = cls.__downsample(df, quantity, cls.max_points)
+
         # get layout 
         plot_layout = cls.plot_layout_key[quantity]
 
@@ -136,6 +162,41 @@ class PlotMainTimeSeries:
         return fig   
 
 
+    @staticmethod
+    def __downsample(df: pd.DataFrame, column: str, n_points: int) -> pd.DataFrame:
+        """
+        Function downsamples a time series to `n_points` rows with Largest-Triangle-Three-Buckets: the first and last 
+        points are kept, and from each of the buckets in between, the point forming the largest triangle with the 
+        previous kept point and the next bucket's average. Peaks and troughs survive, unlike with plain resampling.
+        ~~~
+        Parameters:
+        df : Dataframe with a datetime index, sorted by time.
+        column : Column to downsample on.
+        n_points : Number of rows to keep.
+        """
+        n = len(df)
+        if n <= n_points or n_points < 3:
+            return df
+
+        x = df.index.asi8 / 1e9
+        y = np.nan_to_num(df[column].to_numpy(dtype=float))
+
+        # bucket edges; points 1..n-2 are split into `n_points - 2` buckets, and the last "bucket" is the last point
+        edges = np.append(np.floor(np.arange(n_points - 1) * (n - 2) / (n_points - 2)).astype(int) + 1, n)
+        x_avg = np.add.reduceat(x, edges[:-1]) / np.diff(edges)
+        y_avg = np.add.reduceat(y, edges[:-1]) / np.diff(edges)
+
+        keep = np.empty(n_points, dtype=int)
+        keep[0], keep[-1] = 0, n - 1
+        for bucket in range(n_points - 2):
+            start, end = edges[bucket], edges[bucket + 1]
+            a = keep[bucket]
+            area = np.abs((x[a] - x_avg[bucket + 1]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (y_avg[bucket + 1] - y[a]))
+            keep[bucket + 1] = start + np.argmax(area)
+
+        return df.iloc[keep]
+
+
     @classmethod
     def __query_df(cls, df: pd.DataFrame, granularity: str, quantity: str, start_date: str, end_date: str) -> pd.DataFrame:
         # get relevant columns
@@ -473,7 +534,11 @@ class PlotHoverHistogram:
 
 
     @classmethod 
-    def plot_day_hover_histogram(cls, hoverData, df, quantity, granularity, theme=None):
+    def plot_day_hover_histogram(cls, hoverData, distributions, df, quantity, granularity, theme=None):
+        """
+        Plots the distribution of `quantity` on the hovered point's day of the week, out of the precomputed `distributions`
+        (see `fullcleaningclasses.CreateHoverDistributions`), with the hovered day's value (looked up in `df`) marked.
+        """
 
         # non-prediction curve
         if hoverData["points"][0]["curveNumber"] == 0:
@@ -493,18 +558,8 @@ class PlotHoverHistogram:
             elif granularity == "hourlydemand":
                 point = None
 
-
-        # filter df 
-        df = df.loc[df["day"] == day_name]
-
         fig = go.Figure()
-        fig.add_trace(
-            go.Histogram(
-                x=df[quantity],
-                histnorm="percent",
-                hovertemplate="<extra></extra>Value: %{x}<br>% Share: %{y}",
-            )
-        )
+        cls.__add_distribution(fig, distributions, "day", quantity, day_name)
         if point is not None: 
             fig.add_trace(
                 go.Scatter(
@@ -528,7 +583,11 @@ class PlotHoverHistogram:
     
 
     @classmethod 
-    def plot_hour_hover_histogram(cls, hoverData, df, quantity, theme=None):
+    def plot_hour_hover_histogram(cls, hoverData, distributions, quantity, theme=None):
+        """
+        Plots the distribution of `quantity` on the hovered point's hour of the day, out of the precomputed `distributions`
+        (see `fullcleaningclasses.CreateHoverDistributions`), with the hovered value marked.
+        """
 
         # extract hour name
         hour = int(pd.to_datetime(hoverData["points"][0]["x"]).strftime("%H"))
@@ -536,16 +595,8 @@ class PlotHoverHistogram:
         # get point to hover on 
         point = hoverData["points"][0]["y"]
 
-        df = df[df.index.hour == hour]
-
         fig = go.Figure()
-        fig.add_trace(
-            go.Histogram(
-                x=df[quantity],
-                histnorm="percent",
-                hovertemplate="<extra></extra>Value: %{x}<br>% Share: %{y}",
-            )
-        )
+        cls.__add_distribution(fig, distributions, "hour", quantity, str(hour))
         fig.add_trace(
             go.Scatter(
                 x=[point], 
@@ -567,6 +618,51 @@ class PlotHoverHistogram:
         return fig 
     
 
+    @classmethod
+    def get_client_distributions(cls, distributions: pd.DataFrame, dailydemand: pd.DataFrame) -> dict:
+        """
+        Returns what the browser needs to draw the hover histograms itself (see `assets/hoverhistograms.js`): the precomputed 
+        `distributions` nested as {distribution: {quantity: {key: bins}}}, each quantity's daily values by date, and axis titles.
+        """
+        nested = {}
+        for (distribution, quantity, key), bins in distributions.groupby(["distribution", "quantity", "key"]):
+            nested.setdefault(distribution, {}).setdefault(quantity, {})[key] = {
+                "start": bins["bin_start"].tolist(),
+                "end": bins["bin_end"].tolist(),
+                "percent": bins["percent"].tolist(),
+            }
+
+        daily_values = {
+            quantity: dict(zip(dailydemand[quantity].dropna().index.strftime("%Y-%m-%d"), dailydemand[quantity].dropna().tolist()))
+            for quantity in cls.cleaned_column_names
+        }
+
+        return {
+            "distributions": nested,
+            "dailydemand": daily_values,
+            "column_names": {quantity: names["col_name"] for quantity, names in cls.cleaned_column_names.items()},
+        }
+
+
+    @staticmethod
+    def __add_distribution(fig: go.Figure, distributions: pd.DataFrame, distribution: str, quantity: str, key: str) -> None:
+        """
+        Adds the bins of one precomputed distribution to a figure, drawn like a histogram.
+        """
+        bins = distributions.loc[
+            (distributions["distribution"] == distribution) & (distributions["quantity"] == quantity) & (distributions["key"] == key)
+        ]
+        fig.add_trace(
+            go.Bar(
+                x=(bins["bin_start"] + bins["bin_end"]) / 2,
+                y=bins["percent"],
+                width=bins["bin_end"] - bins["bin_start"],
+                customdata=bins[["bin_start", "bin_end"]],
+                hovertemplate="<extra></extra>Value: %{customdata[0]:.2f} - %{customdata[1]:.2f}<br>% Share: %{y:.2f}",
+            )
+        )
+    
+
     @staticmethod
     def empty_histogram_figure(theme=None) -> go.Figure:
         '''
@@ -14,6 +14,16 @@ image = modal.Image.debian_slim().pip_install("pandas", "numpy", "redis", "boto3
 
 stub = modal.Stub(name="slrpEV-data-dashboard-tasks")
 
+# cores for the independent cleaning branches 
+CLEANING_WORKERS = 4
+
+# high-water mark of the raw data the published demand was cleaned from
+CLEANED_WATERMARK_KEY = "cleaned_watermark"
+
+# persistent volume holding the raw session archive
+archive_volume = modal.Volume.from_name("slrpEV-data-dashboard-archive", create_if_missing=True)
+ARCHIVE_DIR = "/archive"
+
 # logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,20 +37,44 @@ logger = logging.getLogger(__name__)
             "datacleaning.FetchData", 
             "datacleaning.CleanData", 
             "db.utils"
-            )]
+            )],
+        volumes={ARCHIVE_DIR: archive_volume},
+        cpu=CLEANING_WORKERS
         )
 def query_data():
     r = db.get_redis_connection()
 
-    logger.info("Fetching slrpEV data from AWS DyanmoDB...")
-    raw_data = FetchData.scan_all_records()
+    # previously fetched raw records; their high-water mark decides what to fetch
+    logger.info("Loading archived slrpEV data...")
+    archive_volume.reload()
+    previous_raw_data = FetchData.load_archive(archive_dir=ARCHIVE_DIR)
+
+    logger.info("Fetching new slrpEV data from AWS DyanmoDB...")
+    raw_data, new_data = FetchData.fetch_incremental(previous_raw_data)
+    logger.info(f"Fetched {len(new_data)} new or updated records.")
+
+    logger.info("Archiving new slrpEV data...")
+    FetchData.archive_records(new_data, archive_dir=ARCHIVE_DIR)
+    archive_volume.commit()
+
+    # previously cleaned demand, and the records changed since the raw data it was cleaned from; these are taken from 
+    # that raw data's watermark rather than this fetch's, since the archive may hold records of a run that failed to publish
+    previous, changed_data = None, None
+    previous_keys = ["fivemindemand", "hourlydemand", "dailydemand", "monthlydemand"]
+    if not previous_raw_data.empty and r.exists(CLEANED_WATERMARK_KEY) and db.exists(r, previous_keys):
+        previous = dict(zip(previous_keys, db.get_multiple_df(r, previous_keys)))
+        changed_data = FetchData.get_records_since(raw_data, db.get_item(r, CLEANED_WATERMARK_KEY), FetchData.watermark_lookback)
+        logger.info(f"Cleaning {len(changed_data)} records changed since the last snapshot.")
 
     logger.info("Cleaning slrpEV data...")
-    cleaned_dataframes = CleanData.clean_raw_data(raw_data)
+    cleaned_dataframes = CleanData.clean_raw_data(raw_data, previous, changed_data, max_workers=CLEANING_WORKERS)
 
-    logger.info("Serializiing data into parquet and sending to Redis...")
-    for key in cleaned_dataframes.keys():
-        db.send_df(r, cleaned_dataframes[key], key)
+    logger.info("Publishing cleaned data to Redis...")
+    # sites no longer in the data don't keep their charger states
+    version = db.publish_snapshot(r, cleaned_dataframes, replace_prefixes=("chargers_",))
+    # only sent after publishing; if this fails, the older watermark just makes the next run clean more
+    db.send_item(r, CLEANED_WATERMARK_KEY, FetchData.get_watermark(raw_data))
+    logger.info(f"Published snapshot {version}.")
 
     logger.info("Done!")
 
@@ -63,7 +97,7 @@ def query_data():
 def update_params():
     r = db.get_redis_connection()
 
-    if not db.get_item(r, "dailydemand") or not db.get_item(r, "hourlydemand"):
+    if not db.exists(r, ["dailydemand", "hourlydemand"]):
         logger.info("No data found. Fetching data...")
         query_data()
 